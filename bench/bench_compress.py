@@ -0,0 +1,63 @@
+"""Encode time vs output size for the target-size compression stage.
+
+Generates a synthetic clip with ffmpeg's lavfi sources, then runs
+main.compress_to_size() for every preset/mode combination and prints how
+long each encode took and how close it landed to the target. A crf row's
+time includes the two-pass retry when the CRF encode overshoots.
+
+    python bench/bench_compress.py --duration 120 --target-mb 8
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bench_data_"))
+
+import main  # noqa: E402
+
+
+def make_clip(path, duration):
+    subprocess.run([
+        main.FFMPEG_BIN, "-hide_banner", "-loglevel", "error", "-y",
+        "-f", "lavfi", "-i", f"testsrc2=size=1920x1080:rate=30:duration={duration}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}",
+        "-c:v", "libx264", "-preset", "ultrafast", "-crf", "18",
+        "-c:a", "aac", "-shortest", path
+    ], check=True)
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="bench_compress_")
+    os.chdir(workdir)
+    source = os.path.join(workdir, "source.mp4")
+    make_clip(source, args.duration)
+    target = int(args.target_mb * 1024 * 1024)
+    print(f"source: {os.path.getsize(source) / 2**20:.1f} MB, {args.duration}s, target {args.target_mb} MB")
+    print(f"{'mode':<8} {'preset':<10} {'seconds':>8} {'out MB':>8} {'of target':>10}")
+    for mode in args.modes:
+        for preset in args.presets:
+            start = time.perf_counter()
+            try:
+                output = await main.compress_to_size(source, target, args.duration, mode=mode, preset=preset)
+            except main.TooLarge:
+                print(f"{mode:<8} {preset:<10} {time.perf_counter() - start:>8.1f} {'over':>8} {'-':>10}")
+                continue
+            elapsed = time.perf_counter() - start
+            size = os.path.getsize(output)
+            print(f"{mode:<8} {preset:<10} {elapsed:>8.1f} {size / 2**20:>8.2f} {size / target:>10.1%}")
+            os.remove(output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--duration", type=int, default=60)
+    parser.add_argument("--target-mb", type=float, default=8)
+    parser.add_argument("--presets", nargs="+", default=["ultrafast", "veryfast", "fast", "medium"])
+    parser.add_argument("--modes", nargs="+", default=["twopass", "crf"])
+    asyncio.run(run(parser.parse_args()))
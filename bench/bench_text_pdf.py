@@ -0,0 +1,78 @@
+"""Text-to-PDF throughput on 1 KB, 100 KB and 1 MB inputs.
+
+Times main.render_text_pdf() (best of --repeat runs) and, when the old
+fpdf package is importable, the previous FPDF/multi_cell implementation
+for comparison.
+
+    python bench/bench_text_pdf.py --repeat 5
+"""
+import os
+import re
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bench_data_"))
+
+import main  # noqa: E402
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+         "incididunt ut labore et dolore magna aliqua Telegram video download premium").split()
+
+
+def make_text(size):
+    rng = random.Random(size)
+    parts, length = [], 0
+    while length < size:
+        paragraph = " ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 120)))
+        parts.append(paragraph)
+        length += len(paragraph) + 1
+    return "\n".join(parts)[:size]
+
+
+def render_fpdf(text):
+    # The implementation render_text_pdf replaced, kept here as a baseline
+    from fpdf import FPDF
+    pdf = FPDF()
+    pdf.set_auto_page_break(auto=True, margin=15)
+    pdf.add_page()
+    pdf.set_font("Arial", size=12)
+    for paragraph in re.split(r'\r?\n|\u2028|\u2029', text.strip()):
+        for i in range(0, len(paragraph), 90):
+            pdf.multi_cell(0, 10, paragraph[i:i + 90])
+    return pdf.output(dest="S")
+
+
+def best_of(fn, text, repeat):
+    best, out = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn(text)
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def main_bench(args):
+    renderers = [("render_text_pdf", main.render_text_pdf)]
+    try:
+        import fpdf  # noqa: F401
+        renderers.append(("fpdf (old)", render_fpdf))
+    except ImportError:
+        pass
+    print(f"{'renderer':<16} {'input':>8} {'ms':>9} {'MB/s':>8} {'out KB':>8}")
+    for size in (1024, 100 * 1024, 1024 * 1024):
+        text = make_text(size)
+        for name, fn in renderers:
+            elapsed, out = best_of(fn, text, args.repeat)
+            print(f"{name:<16} {size // 1024:>6}KB {elapsed * 1000:>9.1f} "
+                  f"{size / 2**20 / elapsed:>8.2f} {len(out) / 1024:>8.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=3)
+    main_bench(parser.parse_args())
@@ -0,0 +1,57 @@
+"""Per-request yt-dlp setup cost: a fresh YoutubeDL vs the warmed pool.
+
+"fresh" is what each download used to do: build YoutubeDL(opts), look up
+the extractor and build the format selector, then close it. "pooled" is
+main.ydl_pool.get(), which reuses an instance and only swaps in the
+per-job output template, format and size limit. No network is used.
+
+    python bench/bench_ydl_pool.py --iterations 200
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bench_data_"))
+
+import yt_dlp  # noqa: E402
+import main  # noqa: E402
+
+
+def job_opts(mode, i):
+    opts = main.ydl_options(mode, f"file_bench_{i}.mp4")
+    opts["format"] = "18/best[height<=480]"
+    return opts
+
+
+def fresh(opts):
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        ydl.get_info_extractor("Generic")
+        ydl.build_format_selector(opts["format"])
+
+
+def pooled(opts):
+    with main.ydl_pool.get(opts) as ydl:
+        ydl.get_info_extractor("Generic")
+
+
+def measure(fn, mode, iterations):
+    fn(job_opts(mode, -1))          # first call pays imports / pool creation
+    start = time.perf_counter()
+    for i in range(iterations):
+        fn(job_opts(mode, i))
+    return (time.perf_counter() - start) / iterations
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=100)
+    args = parser.parse_args()
+    print(f"{'mode':<6} {'fresh ms':>9} {'pooled ms':>10} {'speedup':>8}")
+    for mode in ("video", "audio"):
+        a = measure(fresh, mode, args.iterations)
+        b = measure(pooled, mode, args.iterations)
+        print(f"{mode:<6} {a * 1000:>9.3f} {b * 1000:>10.3f} {a / b:>7.1f}x")
@@ -0,0 +1,412 @@
+"""Offline load test: replay synthetic updates into main.py's /webhook.
+
+Starts main.py as a subprocess pointed at local stand-ins served by this
+script, so nothing leaves the machine:
+
+- a fake Bot API (TELEGRAM_API_URL) that answers every method the bot
+  uses, serves photo downloads and records what the bot sends
+- canned media at /media/clip-<n>.mp4, fetched by yt-dlp's generic
+  extractor as direct links (each path is unique and carries a distinct
+  `free` atom, so neither the file-id nor the conversion cache short-cuts it)
+- a fake NowPayments API (NOWPAYMENTS_API_URL) for invoices
+
+Each scenario posts requests at --rate per second (open loop) and reports
+p50/p99 end-to-end latency, throughput, and the bot process' peak RSS and
+CPU. Latency runs from the webhook POST to the bot's final API call for
+that chat (sendVideo, sendDocument, ...). Needs ffmpeg on PATH.
+
+    python bench/loadtest.py --scenarios video conversion pdf --count 30 --rate 5
+"""
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import asyncio
+import argparse
+import itertools
+import subprocess
+import tempfile
+
+from aiohttp import web, ClientSession, ClientTimeout
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_TOKEN = "123456:bench"
+ADMIN_ID = 999
+IPN_SECRET = "bench-secret"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+FAILURE_PREFIXES = ("❌", "⛔", "🚦", "⏳ Please wait")
+SCENARIOS = ["video", "conversion", "pdf", "broadcast", "ipn"]
+
+
+class BotError(Exception):
+    pass
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def make_media(workdir):
+    clip = os.path.join(workdir, "clip.mp4")
+    photo = os.path.join(workdir, "photo.jpg")
+    ffmpeg = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y"]
+    subprocess.run(ffmpeg + [
+        "-f", "lavfi", "-i", "testsrc2=size=640x360:rate=25:duration=8",
+        "-f", "lavfi", "-i", "sine=frequency=440:duration=8",
+        "-c:v", "libx264", "-preset", "veryfast", "-c:a", "aac", "-shortest",
+        "-movflags", "+faststart", clip
+    ], check=True)
+    subprocess.run(ffmpeg + ["-f", "lavfi", "-i", "testsrc2=size=1280x960", "-frames:v", "1", photo], check=True)
+    with open(clip, "rb") as f, open(photo, "rb") as g:
+        return f.read(), g.read()
+
+
+class FakeServices:
+    """Fake Bot API, media host and NowPayments API on one aiohttp app."""
+
+    def __init__(self, port, clip, photo):
+        self.base = f"http://127.0.0.1:{port}"
+        self.clip = clip
+        self.photo = photo
+        self.ids = itertools.count(1000)
+        self.events = []                  # (perf_counter, method, chat id, params)
+        self.waiters = []                 # (chat id, done(method, params), future)
+        self.invoices = {}                # username -> (invoice id, order id)
+        self.app = web.Application(client_max_size=256 * 1024 * 1024)
+        self.app.router.add_post("/bot{token}/{method}", self.bot_api)
+        self.app.router.add_get("/file/bot{token}/{path:.*}", self.file_download)
+        self.app.router.add_get("/media/{name}", self.media)
+        self.app.router.add_post("/np/invoice", self.np_create)
+        self.app.router.add_delete("/np/invoice/{id}", self.np_cancel)
+
+    def expect(self, chat_id, done):
+        fut = asyncio.get_running_loop().create_future()
+        self.waiters.append((chat_id, done, fut))
+        return fut
+
+    def emit(self, method, params):
+        chat = int(params.get("chat_id") or 0)
+        event = (time.perf_counter(), method, chat, params)
+        self.events.append(event)
+        text = str(params.get("text", ""))
+        for waiter in list(self.waiters):
+            chat_id, done, fut = waiter
+            if chat_id != chat:
+                continue
+            if fut.done():
+                self.waiters.remove(waiter)
+            elif done(method, params):
+                fut.set_result(event)
+                self.waiters.remove(waiter)
+            elif method in ("sendMessage", "editMessageText") and text.startswith(FAILURE_PREFIXES):
+                fut.set_exception(BotError(text))
+                self.waiters.remove(waiter)
+
+    def message(self, chat_id, **fields):
+        return dict({"message_id": next(self.ids), "date": int(time.time()), "from": BOT_USER,
+                     "chat": {"id": chat_id, "type": "private"}}, **fields)
+
+    def file_ref(self, prefix):
+        n = next(self.ids)
+        return {"file_id": f"{prefix}_{n}", "file_unique_id": f"u{prefix}{n}"}
+
+    async def bot_api(self, request):
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = {k: v for k, v in (await request.post()).items() if isinstance(v, str)}
+        chat = int(params.get("chat_id") or 0)
+        if method == "getMe":
+            result = BOT_USER
+        elif method == "getFile":
+            result = dict(file_id=params["file_id"], file_unique_id="f" + params["file_id"],
+                          file_size=len(self.photo), file_path=f"photos/{params['file_id']}.jpg")
+        elif method in ("sendMessage", "editMessageText"):
+            result = self.message(chat, text=params.get("text", ""))
+        elif method == "sendVideo":
+            result = self.message(chat, video=dict(self.file_ref("video"), width=640, height=360, duration=8))
+        elif method == "sendAudio":
+            result = self.message(chat, audio=dict(self.file_ref("audio"), duration=8))
+        elif method == "sendDocument":
+            result = self.message(chat, document=self.file_ref("doc"))
+        else:
+            result = True                # setWebhook, answerCallbackQuery, deleteMessage, ...
+        self.emit(method, params)
+        return web.json_response({"ok": True, "result": result})
+
+    async def file_download(self, request):
+        return web.Response(body=self.photo, content_type="image/jpeg")
+
+    async def media(self, request):
+        # A trailing `free` box keeps the MP4 valid while making every clip's digest unique
+        tag = request.match_info["name"].encode()
+        body = self.clip + struct.pack(">I", 8 + len(tag)) + b"free" + tag
+        return web.Response(body=body, content_type="video/mp4")
+
+    async def np_create(self, request):
+        payload = await request.json()
+        inv_id = next(self.ids)
+        self.invoices[payload["order_id"].split(":")[0]] = (inv_id, payload["order_id"])
+        return web.json_response({"id": inv_id, "invoice_url": f"{self.base}/np/pay/{inv_id}"})
+
+    async def np_cancel(self, request):
+        return web.json_response({})
+
+
+class ProcessSampler:
+    """Peak RSS and CPU time (including reaped children, e.g. ffmpeg) from /proc."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.peak_rss = 0
+        self.task = None
+
+    def cpu_seconds(self):
+        with open(f"/proc/{self.pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return sum(int(x) for x in fields[11:15]) / os.sysconf("SC_CLK_TCK")
+
+    def rss(self):
+        with open(f"/proc/{self.pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    async def _run(self):
+        while True:
+            self.peak_rss = max(self.peak_rss, self.rss())
+            await asyncio.sleep(0.1)
+
+    def start(self):
+        self.peak_rss = self.rss()
+        self.cpu_start, self.wall_start = self.cpu_seconds(), time.perf_counter()
+        self.task = asyncio.create_task(self._run())
+
+    def stop(self):
+        self.task.cancel()
+        wall = time.perf_counter() - self.wall_start
+        return self.peak_rss, (self.cpu_seconds() - self.cpu_start) / wall if wall else 0.0
+
+
+class Harness:
+    def __init__(self, args, fake, bot_port):
+        self.args = args
+        self.fake = fake
+        self.webhook = f"http://127.0.0.1:{bot_port}/webhook"
+        self.ipn = f"http://127.0.0.1:{bot_port}/ipn"
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.session = None
+        self.rejected = 0
+
+    # --- update builders ---
+    def user(self, uid):
+        return {"id": uid, "is_bot": False, "first_name": f"u{uid}", "username": f"u{uid}"}
+
+    def message(self, uid, text=None, **fields):
+        msg = {"message_id": next(self.message_ids), "date": int(time.time()),
+               "chat": {"id": uid, "type": "private"}, "from": self.user(uid)}
+        if text is not None:
+            msg["text"] = text
+            if text.startswith("/"):
+                msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        msg.update(fields)
+        return {"update_id": next(self.update_ids), "message": msg}
+
+    def callback(self, uid, data):
+        return {"update_id": next(self.update_ids), "callback_query": {
+            "id": str(next(self.message_ids)), "from": self.user(uid), "chat_instance": "bench", "data": data,
+            "message": {"message_id": next(self.message_ids), "date": int(time.time()), "from": BOT_USER,
+                        "chat": {"id": uid, "type": "private"}, "text": "menu"}}}
+
+    async def post(self, update):
+        while True:
+            async with self.session.post(self.webhook, json=update) as resp:
+                if resp.status != 503:
+                    return
+            # Same as Telegram: redeliver after the bot sheds load
+            self.rejected += 1
+            await asyncio.sleep(1)
+
+    async def send(self, uid, update, done):
+        fut = self.fake.expect(uid, done)
+        await self.post(update)
+        return await asyncio.wait_for(fut, self.args.timeout)
+
+    # --- building blocks ---
+    async def start_user(self, uid):
+        await self.send(uid, self.message(uid, "/start"), lambda m, p: m == "sendMessage")
+
+    async def download_video(self, uid):
+        url = f"{self.fake.base}/media/clip-{uid}.mp4"
+        return await self.send(uid, self.message(uid, url), lambda m, p: m == "sendVideo")
+
+    async def setup(self, uids, step):
+        sem = asyncio.Semaphore(20)
+
+        async def one(uid):
+            async with sem:
+                return await step(uid)
+        return await asyncio.gather(*[one(uid) for uid in uids])
+
+    async def drive(self, uids, request):
+        """Fire request(uid) at --rate per second; return (latencies, errors, elapsed)."""
+        loop = asyncio.get_running_loop()
+        latencies, errors = [], []
+
+        async def timed(uid):
+            start = time.perf_counter()
+            try:
+                await request(uid)
+                latencies.append(time.perf_counter() - start)
+            except Exception as e:
+                errors.append(repr(e))
+
+        begin = loop.time()
+        tasks = []
+        for i, uid in enumerate(uids):
+            delay = begin + i / self.args.rate - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(timed(uid)))
+        await asyncio.gather(*tasks)
+        return latencies, errors, loop.time() - begin
+
+    # --- scenarios: each returns (latencies, errors, elapsed) ---
+    async def scenario_video(self, uids):
+        await self.setup(uids, self.start_user)
+        return await self.drive(uids, self.download_video)
+
+    async def scenario_conversion(self, uids):
+        async def prepare(uid):
+            await self.start_user(uid)
+            _, _, _, params = await self.download_video(uid)
+            return json.loads(params["reply_markup"])["inline_keyboard"][0][1]["callback_data"]
+        buttons = dict(zip(uids, await self.setup(uids, prepare)))
+        return await self.drive(uids, lambda uid: self.send(
+            uid, self.callback(uid, buttons[uid]), lambda m, p: m == "sendDocument"))
+
+    async def scenario_pdf(self, uids):
+        await self.setup(uids, self.start_user)
+
+        async def request(uid):
+            ack = self.fake.expect(uid, lambda m, p: m == "sendMessage" and "received" in p.get("text", ""))
+            for k in range(self.args.photos):
+                photo = [{"file_id": f"photo_{uid}_{k}", "file_unique_id": f"p{uid}{k}", "width": 1280, "height": 960}]
+                await self.post(self.message(uid, photo=photo, media_group_id=f"album{uid}"))
+            await asyncio.wait_for(ack, self.args.timeout)
+            await self.send(uid, self.message(uid, "/convertpdf"), lambda m, p: m == "sendDocument")
+        return await self.drive(uids, request)
+
+    async def scenario_broadcast(self, uids):
+        # One broadcast to every known user; latency is per recipient
+        await self.setup(uids, self.start_user)
+        await self.start_user(ADMIN_ID)
+        await self.send(ADMIN_ID, self.callback(ADMIN_ID, "admin_broadcast"), lambda m, p: m == "sendMessage")
+        text = f"bench broadcast {time.time()}"
+        begin = time.perf_counter()
+        try:
+            await self.send(ADMIN_ID, self.message(ADMIN_ID, text),
+                            lambda m, p: m == "editMessageText" and "Broadcast sent" in p.get("text", ""))
+            errors = []
+        except Exception as e:
+            errors = [repr(e)]
+        elapsed = time.perf_counter() - begin
+        latencies = [t - begin for t, method, _, params in self.fake.events
+                     if method == "sendMessage" and params.get("text") == text]
+        return latencies, errors, elapsed
+
+    async def scenario_ipn(self, uids):
+        async def prepare(uid):
+            await self.start_user(uid)
+            await self.send(uid, self.callback(uid, "invoice_2"),
+                            lambda m, p: m == "sendMessage" and "Please pay" in p.get("text", ""))
+        await self.setup(uids, prepare)
+
+        async def request(uid):
+            inv_id, order_id = self.fake.invoices[f"u{uid}"]
+            payload = {"ipn_secret": IPN_SECRET, "payment_status": "finished",
+                       "invoice_id": inv_id, "order_id": order_id}
+            async with self.session.post(self.ipn, json=payload) as resp:
+                if resp.status != 200:
+                    raise BotError(f"IPN returned {resp.status}")
+        return await self.drive(uids, request)
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+async def wait_for_bot(fake, proc, timeout):
+    deadline = time.monotonic() + timeout
+    while not any(method == "setWebhook" for _, method, _, _ in fake.events):
+        if proc.returncode is not None or time.monotonic() > deadline:
+            raise RuntimeError("bot did not start; see bot.log in the work directory")
+        await asyncio.sleep(0.2)
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="bench_load_")
+    print(f"work directory: {workdir}")
+    clip, photo = make_media(workdir)
+    fake_port, bot_port = free_port(), free_port()
+    fake = FakeServices(fake_port, clip, photo)
+    runner = web.AppRunner(fake.app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", fake_port).start()
+
+    env = dict(os.environ,
+               BOT_TOKEN=BOT_TOKEN, ADMIN_ID=str(ADMIN_ID), PORT=str(bot_port),
+               RENDER_EXTERNAL_URL=f"http://127.0.0.1:{bot_port}",
+               TELEGRAM_API_URL=fake.base, NOWPAYMENTS_API_URL=f"{fake.base}/np",
+               NOWPAYMENTS_API_KEY="bench", NOWPAYMENTS_IPN_SECRET=IPN_SECRET,
+               DATA_DIR=os.path.join(workdir, "data"))
+    log = open(os.path.join(workdir, "bot.log"), "wb")
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(ROOT, "main.py"), cwd=workdir, env=env, stdout=log, stderr=log)
+    harness = Harness(args, fake, bot_port)
+    harness.session = ClientSession(timeout=ClientTimeout(total=args.timeout))
+    try:
+        await wait_for_bot(fake, proc, 60)
+        sampler = ProcessSampler(proc.pid)
+        print(f"{'scenario':<11} {'ok':>5} {'err':>5} {'p50 ms':>9} {'p99 ms':>9} {'req/s':>8} "
+              f"{'RSS MB':>8} {'CPU %':>7}")
+        for n, name in enumerate(args.scenarios):
+            uids = range(100000 * (n + 1), 100000 * (n + 1) + args.count)
+            fake.events.clear()
+            sampler.start()
+            latencies, errors, elapsed = await getattr(harness, f"scenario_{name}")(uids)
+            rss, cpu = sampler.stop()
+            print(f"{name:<11} {len(latencies):>5} {len(errors):>5} "
+                  f"{percentile(latencies, 50) * 1000:>9.1f} {percentile(latencies, 99) * 1000:>9.1f} "
+                  f"{len(latencies) / elapsed if elapsed else 0:>8.2f} {rss / 2**20:>8.1f} {cpu * 100:>7.1f}")
+            for error in sorted(set(errors))[:3]:
+                print(f"    {error}")
+        if harness.rejected:
+            print(f"webhook 503s (redelivered): {harness.rejected}")
+    finally:
+        await harness.session.close()
+        if proc.returncode is None:
+            proc.terminate()
+            await proc.wait()
+        log.close()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--count", type=int, default=20, help="requests (or broadcast recipients) per scenario")
+    parser.add_argument("--rate", type=float, default=5, help="requests started per second")
+    parser.add_argument("--photos", type=int, default=5, help="photos per PDF request")
+    parser.add_argument("--timeout", type=float, default=180)
+    asyncio.run(run(parser.parse_args()))
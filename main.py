@@ -1,17 +1,38 @@
 # --- [IMPORTS & SETUP] ---
+# Heavy optional modules (yt_dlp, PIL) are imported on first use so the
+# web server binds quickly; see load_yt_dlp() and finish_startup().
+import time
+BOOT_STARTED = time.perf_counter()
 import os
 import re
+import sys
 import ssl
 import json
 import logging
-import yt_dlp
-import ffmpeg
 import asyncio
 import csv
-from PIL import Image
+import io
+import zlib
+import functools
+import glob
+import hashlib
+import urllib.parse
+import heapq
+import sqlite3
+import threading
+import collections
+import itertools
+import subprocess
+import multiprocessing
+import bisect
+import contextlib
+import contextvars
+import traceback
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime, timedelta
 from aiohttp import web
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import RetryAfter, Forbidden, BadRequest, NetworkError
 from telegram.ext import (
     Application, CommandHandler, MessageHandler,
     CallbackQueryHandler, ContextTypes, filters
@@ -19,47 +40,711 @@ from telegram.ext import (
 import aiohttp
 import uuid
 
-# === NEW: import fpdf for Text-to-PDF ===
-from fpdf import FPDF
-
 ssl._create_default_https_context = ssl._create_unverified_context
 logging.basicConfig(level=logging.INFO)
 
+boot_timings = []          # (step, seconds) for the startup report
+_boot_last = BOOT_STARTED
+
+def boot_mark(step):
+    """Record the time spent since the previous mark under `step`."""
+    global _boot_last
+    now = time.perf_counter()
+    boot_timings.append((step, now - _boot_last))
+    _boot_last = now
+
+boot_mark("imports")
+
 BOT_TOKEN      = os.getenv("BOT_TOKEN")
 APP_URL        = os.getenv("RENDER_EXTERNAL_URL")
 PORT           = int(os.getenv("PORT", 10000))
-ADMIN_ID       = 1378825382
+ADMIN_ID       = int(os.getenv("ADMIN_ID", 1378825382))
 CHANNEL_URL    = "https://t.me/Downloadassaas"
-DATA_FILE      = "/mnt/data/users.json"
+DATA_DIR       = os.getenv("DATA_DIR", "/mnt/data")
+DATA_FILE      = os.path.join(DATA_DIR, "users.json")
+DB_FILE        = os.path.join(DATA_DIR, "bot.db")
+STORE_BACKEND  = os.getenv("STORE_BACKEND", "sqlite")   # "sqlite" or "json"
+STORE_FLUSH_INTERVAL = float(os.getenv("STORE_FLUSH_INTERVAL", 0.5))
 NOW_API_KEY    = os.getenv("NOWPAYMENTS_API_KEY")
 NOW_IPN_SECRET = os.getenv("NOWPAYMENTS_IPN_SECRET")
-
-application      = Application.builder().token(BOT_TOKEN).build()
-file_registry    = {}
-image_collections = {}
-pdf_trials       = {}
-support_messages = {}
-pending_invoices = {}  # invoice_id -> (username, amount)
+NOW_API_URL    = os.getenv("NOWPAYMENTS_API_URL", "https://api.nowpayments.io/v1")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")   # overridden by bench/loadtest.py
+
+# Download engine limits (see [DOWNLOAD ENGINE])
+DOWNLOAD_WORKERS   = int(os.getenv("DOWNLOAD_WORKERS", 3))
+DOWNLOADS_PER_USER = int(os.getenv("DOWNLOADS_PER_USER", 1))
+DOWNLOADS_WAITING_PER_USER = int(os.getenv("DOWNLOADS_WAITING_PER_USER", 3))   # links queued behind those
+DOWNLOAD_QUEUE_MAX = int(os.getenv("DOWNLOAD_QUEUE_MAX", 50))
+UPLOAD_LIMIT       = int(os.getenv("UPLOAD_LIMIT_MB", 50)) * 1024 * 1024   # Bot API upload cap
+
+# Webhook ingestion (see [WEBHOOK SETUP])
+WEBHOOK_QUEUE_MAX  = int(os.getenv("WEBHOOK_QUEUE_MAX", 1000))
+UPDATE_WORKERS     = int(os.getenv("UPDATE_WORKERS", 32))
+
+# Multi-process mode (see [WORKER FRONT]): with WORKERS > 1 the process
+# started from the command line is a front that forwards updates to
+# WORKERS copies of this bot, each listening on WORKER_BASE_PORT + index.
+WORKERS          = int(os.getenv("WORKERS", 1))
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", PORT + 1))
+WORKER_INDEX     = os.getenv("WORKER_INDEX")        # set by the front on its workers
+IS_FRONT         = WORKERS > 1 and WORKER_INDEX is None   # only forwards; holds no bot state
+IS_PRIMARY       = WORKER_INDEX == "0" if WORKERS > 1 else True   # runs the once-per-deployment jobs
+
+# Updates are fed to application.process_update by update_dispatcher (see
+# [WEBHOOK SETUP]), which runs different chats concurrently.
+application      = (Application.builder().token(BOT_TOKEN)
+                    .base_url(f"{TELEGRAM_API_URL}/bot")
+                    .base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+                    .build())
+# Per-user session state (file_registry, image_collections, pdf_trials,
+# support_messages, remote_files, pending_invoices) lives in bounded
+# TTLMaps, see [SESSION STATE].
 
 # === NEW: Broadcast state stored in memory per admin ===
 #    We'll use context.user_data to track "awaiting_broadcast" for admin.
 
-if not os.path.exists("/mnt/data"):
-    os.makedirs("/mnt/data")
+if not os.path.exists(DATA_DIR):
+    os.makedirs(DATA_DIR)
 
 
-# --- [DATA STORE] ---
-def load_users():
-    if os.path.exists(DATA_FILE):
-        with open(DATA_FILE, "r") as f:
-            return json.load(f)
-    return {}
+# --- [METRICS] ---
+# In-process counters and histograms rendered in Prometheus text format by
+# GET /metrics. Recording is a list increment on the event loop; gauges are
+# only evaluated, and the loop-lag probe only started, when someone scrapes.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+LOOP_LAG_INTERVAL = 0.5
 
-def save_users(data):
-    with open(DATA_FILE, "w") as f:
-        json.dump(data, f, indent=2)
+class Histogram:
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)   # last slot is +Inf
+        self.sum = 0.0
 
-users = load_users()
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @contextlib.contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {total}')
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {total}")
+        return lines
+
+download_seconds = Histogram("bot_download_seconds", "yt-dlp download time per job")
+ffmpeg_seconds   = Histogram("bot_ffmpeg_seconds", "ffmpeg run time per invocation")
+upload_seconds   = Histogram("bot_upload_seconds", "Telegram upload time per file")
+flush_seconds    = Histogram("bot_user_flush_seconds", "Time to write dirty users to the store")
+loop_lag_seconds = Histogram("bot_event_loop_lag_seconds", "Event loop scheduling delay",
+                             (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+histograms = [download_seconds, ffmpeg_seconds, upload_seconds, flush_seconds, loop_lag_seconds]
+
+handler_calls  = collections.Counter()
+handler_errors = collections.Counter()
+current_handler = contextvars.ContextVar("current_handler", default="unknown")
+gauges = []              # (name, type, help, fn); fn returns a number or {label: number}
+loop_lag_task = None
+
+def instrumented(fn):
+    """Count calls and uncaught errors of a handler."""
+    name = fn.__name__
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        handler_calls[name] += 1
+        current_handler.set(name)
+        try:
+            return await fn(*args, **kwargs)
+        except Exception:
+            handler_errors[name] += 1
+            raise
+    return wrapper
+
+def handler_failed():
+    """Count an error the running handler caught and reported to the user itself."""
+    handler_errors[current_handler.get()] += 1
+
+def gauge(name, help, fn, kind="gauge"):
+    gauges.append((name, kind, help, fn))
+
+async def loop_lag_probe():
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        loop_lag_seconds.observe(max(0.0, loop.time() - start - LOOP_LAG_INTERVAL))
+
+def render_metrics():
+    lines = []
+    for hist in histograms:
+        lines.extend(hist.render())
+    for name, counter, help in (("bot_handler_calls_total", handler_calls, "Handler invocations"),
+                                ("bot_handler_errors_total", handler_errors, "Handler invocations that failed")):
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} counter"]
+        lines += [f'{name}{{handler="{h}"}} {n}' for h, n in sorted(counter.items())]
+    for name, kind, help, fn in gauges:
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+        value = fn()
+        if isinstance(value, dict):
+            lines += [f"{name}{{{label}}} {v}" for label, v in value.items()]
+        else:
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+async def metrics_handler(request):
+    global loop_lag_task
+    if loop_lag_task is None:
+        loop_lag_task = asyncio.create_task(loop_lag_probe())
+        background_tasks.append(loop_lag_task)
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+
+# --- [PROFILER] ---
+# /profile samples every thread's stack from a background thread for a
+# window and returns folded stacks (flamegraph.pl / speedscope input). The
+# loop watchdog runs always: a heartbeat callback on the event loop and a
+# thread that logs the loop's stack whenever the heartbeat stalls for more
+# than LOOP_BLOCK_THRESHOLD, i.e. some callback is blocking the loop.
+PROFILE_INTERVAL     = 0.005
+PROFILE_MAX_SECONDS  = 300
+LOOP_BLOCK_THRESHOLD = float(os.getenv("LOOP_BLOCK_THRESHOLD", 0.5))
+WATCHDOG_INTERVAL    = 0.1
+
+def sample_stacks(seconds, interval=PROFILE_INTERVAL):
+    """Collect folded stacks of all threads (but this one) for `seconds`."""
+    own = threading.get_ident()
+    names = {}
+    folded = collections.Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            if ident not in names:
+                names = {t.ident: t.name for t in threading.enumerate()}
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            folded[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return "".join(f"{stack} {count}\n" for stack, count in folded.most_common())
+
+class LoopWatchdog:
+    """Logs the event loop's stack when a callback holds it past `threshold`."""
+    def __init__(self, threshold, interval=WATCHDOG_INTERVAL):
+        self.threshold = threshold
+        self.interval = interval
+        self.blocks = 0
+        self.last_beat = time.monotonic()
+        self.loop_thread = None
+        self.stop_event = threading.Event()
+
+    def _beat(self):
+        self.last_beat = time.monotonic()
+        self.handle = self.loop.call_later(self.interval, self._beat)
+
+    def _watch(self):
+        reported = None
+        while not self.stop_event.wait(self.interval):
+            beat = self.last_beat
+            stalled = time.monotonic() - beat
+            if stalled < self.threshold or reported == beat:
+                continue
+            reported = beat
+            self.blocks += 1
+            frame = sys._current_frames().get(self.loop_thread)
+            stack = "".join(traceback.format_stack(frame)) if frame else "(no frame)"
+            logging.warning(f"Event loop blocked for {stalled:.2f}s:\n{stack}")
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self._beat()
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.handle.cancel()
+
+loop_watchdog = LoopWatchdog(LOOP_BLOCK_THRESHOLD)
+profile_running = threading.Event()
+
+
+# --- [DATA STORE] ---
+# `users` is the in-memory working set. Handlers mutate it and call
+# save_user(username); dirty records are written in one batch every
+# STORE_FLUSH_INTERVAL seconds (group commit) by user_store_flusher().
+db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+background_tasks = []
+
+def open_db(path=DB_FILE):
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+# Shared connection for every SQLite-backed table; writes go through db_executor
+state_db = open_db()
+
+def db_submit(sql, rows):
+    """Queue a batched write on the db thread; returns a concurrent Future."""
+    def run():
+        # isolation_level=None autocommits each statement; one transaction per batch
+        with state_db:
+            state_db.execute("BEGIN")
+            state_db.executemany(sql, rows)
+    return db_executor.submit(run)
+
+class JsonUserStore:
+    """Legacy backend: the whole table in one JSON file, replaced atomically."""
+    def __init__(self, path):
+        self.path = path
+        self.data = {}
+
+    def load_all(self):
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                self.data = json.load(f)
+        return {k: dict(v) for k, v in self.data.items()}
+
+    def write(self, changes, bases=None):
+        for username, record in changes.items():
+            if record is None:
+                self.data.pop(username, None)
+            else:
+                self.data[username] = json.loads(record)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.data, f)
+        os.replace(tmp, self.path)
+        return changes
+
+class SqliteUserStore:
+    """One row per user in a WAL-mode SQLite table; writes touch only changed rows.
+
+    With a `writer` id every write is also appended to user_changes, a feed
+    other worker processes poll to refresh their copy of `users`.
+    """
+    def __init__(self, conn, writer=None):
+        self.conn = conn
+        self.writer = writer
+        self.conn.execute("CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY NOT NULL, data TEXT NOT NULL)")
+        if not self.conn.execute("SELECT \"notnull\" FROM pragma_table_info('users') WHERE name = 'username'").fetchone()[0]:
+            # Older tables accepted NULL usernames; rebuild without those rows
+            with self.conn:
+                self.conn.execute("BEGIN")
+                self.conn.execute("CREATE TABLE users_new (username TEXT PRIMARY KEY NOT NULL, data TEXT NOT NULL)")
+                self.conn.execute("INSERT INTO users_new SELECT username, data FROM users WHERE username IS NOT NULL")
+                self.conn.execute("DROP TABLE users")
+                self.conn.execute("ALTER TABLE users_new RENAME TO users")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS user_changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                          "username TEXT NOT NULL, writer TEXT NOT NULL, ts REAL NOT NULL)")
+
+    def load_all(self):
+        return {u: json.loads(d) for u, d in self.conn.execute("SELECT username, data FROM users")}
+
+    def write(self, changes, bases=None):
+        """Store `changes` ({username: JSON or None}) and return what was stored.
+
+        With `bases` (each record as the caller last saw it in the table) a
+        row another process changed since is merged with merge_user instead
+        of overwritten; the read and write share one locked transaction.
+        """
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            if bases is not None:
+                changes = dict(changes)
+                names = [u for u, d in changes.items() if d is not None]
+                for i in range(0, len(names), 500):
+                    chunk = names[i:i + 500]
+                    for u, stored in self.conn.execute(
+                            f"SELECT username, data FROM users WHERE username IN ({','.join('?' * len(chunk))})",
+                            chunk):
+                        if stored != bases.get(u):
+                            merged = merge_user(json.loads(bases.get(u) or "{}"), json.loads(changes[u]),
+                                                json.loads(stored))
+                            changes[u] = json.dumps(merged)
+            upserts = [(u, d) for u, d in changes.items() if d is not None]
+            deletes = [(u,) for u, d in changes.items() if d is None]
+            self.conn.executemany(
+                "INSERT INTO users (username, data) VALUES (?, ?) "
+                "ON CONFLICT(username) DO UPDATE SET data = excluded.data", upserts)
+            self.conn.executemany("DELETE FROM users WHERE username = ?", deletes)
+            if self.writer:
+                now = time.time()
+                self.conn.executemany("INSERT INTO user_changes (username, writer, ts) VALUES (?, ?, ?)",
+                                      [(u, self.writer, now) for u in changes])
+        return changes
+
+    def feed_position(self):
+        return self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM user_changes").fetchone()[0]
+
+    def changes_since(self, seq):
+        """Users written by other processes after `seq`: (new seq, {username: record or None})."""
+        rows = self.conn.execute("SELECT seq, username FROM user_changes WHERE seq > ? AND writer != ? "
+                                 "ORDER BY seq", (seq, self.writer)).fetchall()
+        if not rows:
+            return seq, {}
+        names = list({u for _, u in rows})
+        found = {}
+        for i in range(0, len(names), 500):
+            chunk = names[i:i + 500]
+            found.update(self.conn.execute(
+                f"SELECT username, data FROM users WHERE username IN ({','.join('?' * len(chunk))})", chunk))
+        return rows[-1][0], {u: (json.loads(found[u]) if u in found else None) for u in names}
+
+    def prune_changes(self, max_age):
+        with self.conn:
+            self.conn.execute("DELETE FROM user_changes WHERE ts < ?", (time.time() - max_age,))
+
+    def migrate_json(self, json_path):
+        # One-off import of the legacy users.json, only into an empty table
+        if not os.path.exists(json_path):
+            return
+        if self.conn.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+            return
+        with open(json_path, "r") as f:
+            legacy = json.load(f)
+        self.write({u: json.dumps(d) for u, d in legacy.items()})
+        os.replace(json_path, json_path + ".migrated")
+        logging.info(f"Migrated {len(legacy)} users from {json_path}")
+
+def open_user_store():
+    if STORE_BACKEND == "json":
+        return JsonUserStore(DATA_FILE)
+    store = SqliteUserStore(state_db, writer=str(os.getpid()) if WORKERS > 1 else None)
+    store.migrate_json(DATA_FILE)
+    return store
+
+user_store = open_user_store()
+user_feed_seq = user_store.feed_position() if WORKERS > 1 else 0
+users = user_store.load_all() if not IS_FRONT else {}
+dirty_users = set()
+# Multi-process mode: each user's record as last read from or written to the
+# store, the common base for merging another worker's change into ours.
+user_base = {u: json.dumps(d) for u, d in users.items()} if WORKERS > 1 else {}
+boot_mark("user store")
+USER_FEED_RETENTION = 3600
+
+def save_user(username):
+    dirty_users.add(username)
+    account_user(username)
+
+# /stats aggregates, adjusted by each user's change since it was last
+# counted instead of scanning `users`.
+user_totals  = collections.Counter()   # "users", "premium", "downloads"
+user_contrib = {}                      # username -> (premium plan, downloads) as counted
+
+def account_user(username):
+    old = user_contrib.pop(username, None)
+    if old:
+        user_totals["users"] -= 1
+        user_totals["premium"] -= old[0]
+        user_totals["downloads"] -= old[1]
+    data = users.get(username)
+    if data:
+        new = (data.get("plan") == "premium", data.get("downloads", 0))
+        user_contrib[username] = new
+        user_totals["users"] += 1
+        user_totals["premium"] += new[0]
+        user_totals["downloads"] += new[1]
+
+for _username in users:
+    account_user(_username)
+
+# Per-day activity counters, buffered here and added to daily_stats by the flusher
+state_db.execute("CREATE TABLE IF NOT EXISTS daily_stats (day TEXT NOT NULL, metric TEXT NOT NULL, "
+                 "count INTEGER NOT NULL, PRIMARY KEY (day, metric))")
+daily_pending = collections.Counter()   # (day, metric) -> count not yet written
+
+def record_daily(metric, n=1):
+    daily_pending[(datetime.utcnow().strftime("%Y-%m-%d"), metric)] += n
+
+def flush_daily():
+    if not daily_pending:
+        return None
+    rows = [(day, metric, n) for (day, metric), n in daily_pending.items()]
+    daily_pending.clear()
+    return db_submit("INSERT INTO daily_stats (day, metric, count) VALUES (?, ?, ?) "
+                     "ON CONFLICT(day, metric) DO UPDATE SET count = count + excluded.count", rows)
+
+def daily_series(days):
+    since = (datetime.utcnow() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    series = collections.defaultdict(collections.Counter)   # day -> metric -> count
+    for day, metric, count in state_db.execute(
+            "SELECT day, metric, count FROM daily_stats WHERE day >= ?", (since,)):
+        series[day][metric] = count
+    return series
+
+flush_lock = asyncio.Lock()   # one flush at a time, so a completed flush means on disk
+
+async def flush_users():
+    """Write every dirty user to the store; False if the write failed."""
+    async with flush_lock:
+        return await _flush_users()
+
+async def _flush_users():
+    if not dirty_users:
+        return True
+    changes = {u: (json.dumps(users[u]) if u in users else None) for u in dirty_users}
+    dirty_users.clear()
+    bases = {u: user_base.get(u) for u in changes} if WORKERS > 1 else None
+    try:
+        with flush_seconds.time():
+            stored = await asyncio.get_running_loop().run_in_executor(
+                db_executor, user_store.write, changes, bases)
+    except Exception as e:
+        dirty_users.update(changes)
+        logging.error(f"User store flush failed: {e}")
+        return False
+    if WORKERS > 1:
+        user_base.update(stored)
+        for username, record in stored.items():
+            local = users.get(username)
+            if record != changes[username] and local is not None:
+                # Merged with another worker's write; also keeps any change made meanwhile
+                merged = merge_user(json.loads(changes[username]), local, json.loads(record))
+                local.clear()
+                local.update(merged)
+                index_expiry(username)
+                account_user(username)
+    return True
+
+async def user_store_flusher():
+    while True:
+        await asyncio.sleep(STORE_FLUSH_INTERVAL)
+        await flush_users()
+        flush_daily()
+
+async def user_store_refresher():
+    # Multi-process mode: pick up users other workers changed. A record
+    # with an unflushed local change is merged field by field, so an admin's
+    # /ban or /upgrade survives the owner worker's next download count.
+    global user_feed_seq
+    loop = asyncio.get_running_loop()
+    last_prune = 0
+    while True:
+        await asyncio.sleep(STORE_FLUSH_INTERVAL)
+        try:
+            user_feed_seq, changed = await loop.run_in_executor(db_executor, user_store.changes_since, user_feed_seq)
+            if IS_PRIMARY and time.time() - last_prune > USER_FEED_RETENTION / 4:
+                await loop.run_in_executor(db_executor, user_store.prune_changes, USER_FEED_RETENTION)
+                last_prune = time.time()
+        except Exception as e:
+            logging.error(f"User feed refresh failed: {e}")
+            continue
+        for username, record in changed.items():
+            local = users.get(username)
+            if record is None:
+                user_base.pop(username, None)
+                if username not in dirty_users:
+                    users.pop(username, None)
+            else:
+                base = json.loads(user_base.get(username) or "{}")
+                user_base[username] = json.dumps(record)
+                if local is None:
+                    users[username] = record
+                else:
+                    # Update in place: handlers may hold a reference to the record
+                    merged = merge_user(base, local, record) if username in dirty_users else record
+                    local.clear()
+                    local.update(merged)
+            index_expiry(username)
+            account_user(username)
+
+USER_COUNTERS = ("downloads",)
+
+def merge_user(base, local, remote):
+    """Three-way merge: take each field the other worker changed unless we changed it too.
+
+    Counters changed on both sides get both increments.
+    """
+    merged = dict(local)
+    for field in base.keys() | remote.keys():
+        if remote.get(field) == base.get(field):
+            continue
+        if local.get(field) == base.get(field):
+            if field in remote:
+                merged[field] = remote[field]
+            else:
+                merged.pop(field, None)
+        elif field in USER_COUNTERS and field in local and field in remote:
+            merged[field] = remote[field] + local[field] - base.get(field, 0)
+    return merged
+
+# Small shared key/value state, readable by every worker process
+state_db.execute("CREATE TABLE IF NOT EXISTS kv (namespace TEXT NOT NULL, key TEXT NOT NULL, "
+                 "value TEXT NOT NULL, updated REAL NOT NULL, PRIMARY KEY (namespace, key))")
+
+
+
+# --- [SESSION STATE] ---
+# Every long-lived in-memory map is a TTLMap: entries expire after `ttl`,
+# the least recently used are evicted past `max_entries`, /memory reports
+# their sizes, and `persist` maps are written through to the kv table so
+# they survive restarts and are visible to every worker.
+STATE_SWEEP_INTERVAL = 60
+state_maps = []
+
+def approx_size(obj):
+    """Rough deep size in bytes of plain containers, strings and bytes."""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(approx_size(k) + approx_size(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(approx_size(x) for x in obj)
+    return size
+
+class TTLMap:
+    """Dict-like map with per-entry expiry and an LRU size cap.
+
+    `sliding` entries get a fresh TTL on every access. With `persist`,
+    memory holds the most recently used entries of a kv namespace: writes
+    go through to SQLite and misses read through, so nothing is lost to
+    eviction. Persisted values must be JSON-serialisable. `max_bytes`
+    additionally caps memory(); call trim() after mutating a value in place.
+    """
+    def __init__(self, name, ttl=None, max_entries=10000, persist=False, sliding=False, max_bytes=None):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.persist = persist
+        self.sliding = sliding
+        self.data = collections.OrderedDict()   # key -> [expires or None, value]
+        self.evictions = 0
+        self.expirations = 0
+        state_maps.append(self)
+
+    def _store(self, key, value, expires):
+        self.data[key] = [expires, value]
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_entries:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def _entry(self, key):
+        entry = self.data.get(key)
+        if entry is None:
+            return self._load(key) if self.persist else None
+        now = time.time()
+        if entry[0] is not None and entry[0] <= now:
+            del self.data[key]
+            self.expirations += 1
+            return None
+        self.data.move_to_end(key)
+        if self.sliding and self.ttl:
+            entry[0] = now + self.ttl
+        return entry
+
+    def _load(self, key):
+        row = state_db.execute("SELECT value, updated FROM kv WHERE namespace = ? AND key = ?",
+                               (self.name, str(key))).fetchone()
+        if row is None:
+            return None
+        expires = row[1] + self.ttl if self.ttl else None
+        if expires is not None and expires <= time.time():
+            return None
+        self._store(key, json.loads(row[0]), expires)
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self._store(key, value, time.time() + self.ttl if self.ttl else None)
+        self.trim()
+        if self.persist:
+            db_submit("INSERT OR REPLACE INTO kv (namespace, key, value, updated) VALUES (?, ?, ?, ?)",
+                      [(self.name, str(key), json.dumps(value), time.time())])
+
+    def __getitem__(self, key):
+        entry = self._entry(key)
+        if entry is None:
+            raise KeyError(key)
+        return entry[1]
+
+    def __contains__(self, key):
+        return self._entry(key) is not None
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        entry = self._entry(key)
+        return entry[1] if entry else default
+
+    def setdefault(self, key, default):
+        entry = self._entry(key)
+        if entry:
+            return entry[1]
+        self[key] = default
+        return default
+
+    def pop(self, key, default=None):
+        entry = self.data.pop(key, None)
+        if self.persist:
+            db_submit("DELETE FROM kv WHERE namespace = ? AND key = ?", [(self.name, str(key))])
+        if entry is None or (entry[0] is not None and entry[0] <= time.time()):
+            return default
+        return entry[1]
+
+    def sweep(self):
+        now = time.time()
+        expired = [k for k, (expires, _) in self.data.items() if expires is not None and expires <= now]
+        for key in expired:
+            del self.data[key]
+        self.expirations += len(expired)
+        if self.persist and self.ttl and IS_PRIMARY:
+            db_submit("DELETE FROM kv WHERE namespace = ? AND updated < ?", [(self.name, now - self.ttl)])
+
+    def memory(self):
+        return sys.getsizeof(self.data) + sum(
+            approx_size(k) + approx_size(v) + 72 for k, (_, v) in self.data.items())   # + entry list
+
+    def trim(self):
+        """Evict least recently used entries until memory() fits max_bytes, keeping the newest."""
+        if self.max_bytes is None:
+            return
+        sizes = [approx_size(k) + approx_size(v) + 72 for k, (_, v) in self.data.items()]
+        total = sys.getsizeof(self.data) + sum(sizes)
+        for size in sizes[:-1]:
+            if total <= self.max_bytes:
+                break
+            self.data.popitem(last=False)
+            self.evictions += 1
+            total -= size
+
+async def state_sweeper():
+    while True:
+        await asyncio.sleep(STATE_SWEEP_INTERVAL)
+        for state_map in state_maps:
+            state_map.sweep()
+        for cache in (media_cache, conversion_cache):
+            cache.prune()
+
+# Photos waiting for /convertpdf, dropped if the user goes quiet or the
+# photos held for all users outgrow IMAGE_SESSION_MAX_MB
+image_collections = TTLMap("image_collections", ttl=int(os.getenv("IMAGE_SESSION_TTL", 1800)),
+                           max_entries=500, sliding=True,
+                           max_bytes=int(os.getenv("IMAGE_SESSION_MAX_MB", 256)) * 1024 * 1024)
+file_registry     = TTLMap("file_registry", ttl=24 * 3600, max_entries=20000)   # message id -> video path
+pdf_trials        = TTLMap("pdf_trials", max_entries=20000, persist=True)       # user id -> 1 once used
+support_messages  = TTLMap("support_messages", ttl=30 * 24 * 3600, max_entries=5000,
+                           persist=True)   # forwarded message id (admin chat) -> user id
 
 
 # --- [HELPERS] ---
@@ -69,54 +754,804 @@ def is_valid_url(text):
 def generate_filename(ext="mp4"):
     return f"file_{datetime.utcnow().strftime('%Y%m%d%H%M%S%f')}.{ext}"
 
-def is_premium(user):
-    # Only “premium” plan with a valid UTC expiry is premium
-    if user.get("plan") != "premium":
-        return False
+def parse_expiry(user):
     exp = user.get("expires")
-    if not isinstance(exp, str):
-        return False
+    if user.get("plan") != "premium" or not isinstance(exp, str):
+        return None
     try:
-        exp_dt = datetime.fromisoformat(exp)       # naive UTC datetime
-        if datetime.utcnow() < exp_dt:             # compare naive UTC
-            return True
-        # Expired → immediate downgrade
-        user["plan"] = "free"
-        user["downloads"] = 0
-        user.pop("expires", None)
-        save_users(users)
-    except:
-        pass
-    return False
+        return datetime.fromisoformat(exp)         # naive UTC datetime
+    except ValueError:
+        return None
+
+def is_premium(user, username=None):
+    # Only “premium” plan with a valid UTC expiry is premium.
+    # Indexed users are an O(1) lookup; expired ones are downgraded by
+    # expiry_scheduler(), not here.
+    if user.get("plan") != "premium":
+        return False
+    if username is not None and users.get(username) is user:
+        exp_dt = expiry_index.get(username)
+    else:
+        exp_dt = parse_expiry(user)
+    return exp_dt is not None and datetime.utcnow() < exp_dt   # compare naive UTC
+
+
+# --- [EXPIRY SCHEDULER] ---
+# expiry_index holds the parsed expiry of every premium user; expiry_heap
+# orders the same entries by time. Superseded heap entries are skipped
+# lazily when they no longer match the index.
+expiry_index  = {}     # username -> naive UTC datetime
+expiry_heap   = []     # (expires, username)
+expiry_wakeup = asyncio.Event()
+
+def index_expiry(username):
+    """Re-index a user after their plan or `expires` changed."""
+    exp_dt = parse_expiry(users.get(username, {}))
+    if exp_dt is None:
+        expiry_index.pop(username, None)
+        return
+    expiry_index[username] = exp_dt
+    heapq.heappush(expiry_heap, (exp_dt, username))
+    if expiry_heap[0] == (exp_dt, username):
+        expiry_wakeup.set()
+
+def build_expiry_index():
+    expiry_index.clear()
+    expiry_heap.clear()
+    for username in users:
+        exp_dt = parse_expiry(users[username])
+        if exp_dt is not None:
+            expiry_index[username] = exp_dt
+            expiry_heap.append((exp_dt, username))
+    heapq.heapify(expiry_heap)
+
+def expire_user(username):
+    user = users[username]
+    user["plan"] = "free"
+    user["downloads"] = 0
+    user.pop("expires", None)
+    expiry_index.pop(username, None)
+    save_user(username)
+
+async def expiry_scheduler():
+    while True:
+        now = datetime.utcnow()
+        while expiry_heap and expiry_heap[0][0] <= now:
+            exp_dt, username = heapq.heappop(expiry_heap)
+            if expiry_index.get(username) == exp_dt:
+                expire_user(username)
+                logging.info(f"Premium expired for @{username}")
+        delay = 3600
+        if expiry_heap:
+            delay = min(delay, (expiry_heap[0][0] - now).total_seconds())
+        expiry_wakeup.clear()
+        try:
+            await asyncio.wait_for(expiry_wakeup.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
 
-def downgrade_expired_users():
-    now = datetime.utcnow()
-    for username, user in users.items():
-        exp = user.get("expires")
-        if isinstance(exp, str):
-            try:
-                if datetime.fromisoformat(exp) < now:
-                    users[username] = {"plan": "free", "downloads": 0}
-            except:
+build_expiry_index()
+
+
+# --- [FILE JANITOR] ---
+# Every temp/media file is registered with `janitor`, which deletes it once
+# MEDIA_RETENTION seconds pass without use (reuse extends it), evicts the
+# least recently used files while DISK_QUOTA is exceeded, and periodically
+# removes untracked leftovers (crashes, partial downloads) older than the
+# retention window.
+MEDIA_RETENTION       = int(os.getenv("MEDIA_RETENTION", 3600))
+DISK_QUOTA            = int(os.getenv("DISK_QUOTA_MB", 2048)) * 1024 * 1024
+JANITOR_INTERVAL      = 30
+ORPHAN_SWEEP_INTERVAL = 600
+ORPHAN_PATTERNS       = ["file_*", "conv_*",
+                         # left behind by older versions, which saved these and never removed them
+                         "image_*.jpg", os.path.join(DATA_DIR, "export.csv"),
+                         os.path.join(DATA_DIR, "*_converted.gif"), os.path.join(DATA_DIR, "*_text.pdf")]
+
+class FileJanitor:
+    def __init__(self, retention, quota):
+        self.retention = retention
+        self.quota = quota
+        self.files = collections.OrderedDict()   # path -> [expires, size, on_remove], LRU first
+        self.heap = []                           # (expires, path); stale entries are skipped
+        self.used = 0
+
+    def track(self, path, on_remove=None, retention=None):
+        entry = self.files.get(path)
+        if entry and on_remove is None:
+            on_remove = entry[2]
+        self._set(path, time.time() + (retention or self.retention), on_remove)
+        self.enforce_quota()
+
+    def touch(self, path):
+        """Mark a tracked file as used again, extending its retention."""
+        entry = self.files.get(path)
+        if entry:
+            self._set(path, max(entry[0], time.time() + self.retention), entry[2])
+            self.enforce_quota()
+
+    def remove(self, path):
+        entry = self.files.pop(path, None)
+        if entry:
+            self.used -= entry[1]
+            if entry[2]:
+                entry[2]()
+        if os.path.exists(path):
+            os.remove(path)
+
+    def sweep(self):
+        now = time.time()
+        while self.heap and self.heap[0][0] <= now:
+            expires, path = heapq.heappop(self.heap)
+            entry = self.files.get(path)
+            if entry and entry[0] == expires:
+                self.remove(path)
+
+    def enforce_quota(self):
+        # Never evict the most recently used file; it is usually still being sent
+        while self.used > self.quota and len(self.files) > 1:
+            path = next(iter(self.files))
+            logging.info(f"Disk quota exceeded, evicting {path}")
+            self.remove(path)
+
+    def sweep_orphans(self, min_age):
+        cutoff = time.time() - min_age
+        for pattern in ORPHAN_PATTERNS:
+            for path in glob.glob(pattern):
+                try:
+                    if path not in self.files and os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                        logging.info(f"Removed orphaned file {path}")
+                except OSError:
+                    pass
+
+    def _set(self, path, expires, on_remove):
+        old = self.files.pop(path, None)
+        if old:
+            self.used -= old[1]
+        size = 0
+        if os.path.exists(path):
+            os.utime(path)          # mtime = last use, so other workers' orphan sweeps spare it
+            size = os.path.getsize(path)
+        self.files[path] = [expires, size, on_remove]
+        self.used += size
+        heapq.heappush(self.heap, (expires, path))
+
+    async def run(self):
+        last_orphan_sweep = 0
+        while True:
+            self.sweep()
+            if IS_PRIMARY and time.time() - last_orphan_sweep >= ORPHAN_SWEEP_INTERVAL:
+                self.sweep_orphans(self.retention)
+                last_orphan_sweep = time.time()
+            await asyncio.sleep(JANITOR_INTERVAL)
+
+janitor = FileJanitor(MEDIA_RETENTION, DISK_QUOTA)
+
+def track_media(path, message_id=None):
+    """Track a sent video; its Convert buttons keep working while it is retained."""
+    def forget():
+        remote_files.pop(path, None)
+        source_digests.pop(path, None)
+        if message_id:
+            file_registry.pop(message_id, None)
+    janitor.track(path, forget)
+
+
+# --- [DOWNLOAD ENGINE] ---
+class DownloadCancelled(Exception):
+    pass
+
+class DownloadLimitReached(Exception):
+    pass
+
+class DownloadQueueFull(Exception):
+    pass
+
+class DownloadJob:
+    def __init__(self, owner, url, opts, info=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.owner = owner
+        self.url = url
+        self.opts = opts
+        self.info = info        # probed metadata; skips a second extraction
+        self.cancel_event = threading.Event()
+        self.future = asyncio.get_running_loop().create_future()
+
+class DownloadEngine:
+    """FIFO of yt-dlp jobs executed on a thread pool, off the event loop.
+
+    At most `workers` downloads run at once, each owner may hold `per_user`
+    jobs (queued + running) and at most `max_queue` jobs may wait. A slot
+    can be reserved before the job is ready, so the limits apply before a
+    link is probed. reserve_in_turn() lets up to `max_waiting` more links
+    per owner wait, in order, for one of the owner's slots to free up.
+    """
+    def __init__(self, workers, per_user, max_queue, max_waiting=0):
+        self.workers = workers
+        self.per_user = per_user
+        self.max_queue = max_queue
+        self.max_waiting = max_waiting
+        self.pending = collections.deque()
+        self.jobs = {}                          # job id -> queued/running job
+        self.per_owner = collections.Counter()
+        self.waiting = {}                       # owner -> deque of futures waiting for a slot
+        self.reserved = 0                       # slots claimed by reserve(), not yet submitted
+        self.running = 0
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ytdl")
+
+    def reserve(self, owner):
+        if self.per_owner[owner] >= self.per_user or self.waiting.get(owner):
+            raise DownloadLimitReached()
+        if len(self.pending) + self.reserved >= self.max_queue:
+            raise DownloadQueueFull()
+        self.per_owner[owner] += 1
+        self.reserved += 1
+
+    def must_wait(self, owner):
+        return self.per_owner[owner] >= self.per_user or bool(self.waiting.get(owner))
+
+    async def reserve_in_turn(self, owner):
+        """reserve(), queueing behind the owner's earlier links instead of refusing."""
+        if not self.must_wait(owner):
+            return self.reserve(owner)
+        waiters = self.waiting.setdefault(owner, collections.deque())
+        if len(waiters) >= self.max_waiting:
+            raise DownloadLimitReached()
+        turn = asyncio.get_running_loop().create_future()
+        waiters.append(turn)
+        try:
+            await turn
+        except asyncio.CancelledError:
+            if turn.done() and not turn.cancelled():
+                self.unreserve(owner)    # the slot was already handed over
+            else:
+                if turn in waiters:
+                    waiters.remove(turn)
+                if not waiters and self.waiting.get(owner) is waiters:
+                    del self.waiting[owner]
+            raise
+
+    def unreserve(self, owner):
+        self.reserved -= 1
+        self._release(owner)
+
+    def _release(self, owner):
+        self.per_owner[owner] -= 1
+        if self.per_owner[owner] <= 0:
+            del self.per_owner[owner]
+        waiters = self.waiting.get(owner)
+        while waiters and waiters[0].done():
+            waiters.popleft()
+        if waiters:
+            # Hand the slot straight to the owner's next link
+            self.per_owner[owner] += 1
+            self.reserved += 1
+            waiters.popleft().set_result(None)
+        if not waiters:
+            self.waiting.pop(owner, None)
+
+    def submit(self, owner, url, opts, info=None, reserved=False):
+        if not reserved:
+            self.reserve(owner)
+        self.reserved -= 1
+        job = DownloadJob(owner, url, opts, info)
+        self.jobs[job.id] = job
+        self.pending.append(job)
+        self._dispatch()
+        return job
+
+    def position(self, job):
+        # 0 means the job is already running
+        try:
+            return self.pending.index(job) + 1
+        except ValueError:
+            return 0
+
+    def cancel(self, job_id, owner=None):
+        job = self.jobs.get(job_id)
+        if not job or (owner is not None and job.owner != owner):
+            return False
+        job.cancel_event.set()
+        if job in self.pending:
+            self.pending.remove(job)
+            self._finish(job)
+            job.future.set_exception(DownloadCancelled())
+        return True
+
+    def _finish(self, job):
+        self.jobs.pop(job.id, None)
+        self._release(job.owner)
+
+    def _dispatch(self):
+        while self.pending and self.running < self.workers:
+            job = self.pending.popleft()
+            self.running += 1
+            asyncio.create_task(self._run(job))
+
+    async def _run(self, job):
+        loop = asyncio.get_running_loop()
+        try:
+            with download_seconds.time():
+                result = await loop.run_in_executor(self.executor, _ytdl_download, job)
+            if not job.future.done():
+                job.future.set_result(result)
+        except Exception as e:
+            if job.cancel_event.is_set():
+                e = DownloadCancelled()
+            if not job.future.done():
+                job.future.set_exception(e)
+        finally:
+            self.running -= 1
+            self._finish(job)
+            self._dispatch()
+
+# Building a YoutubeDL (option processing, extractor and HTTP setup) costs
+# more than a probe of a cached URL, so instances are pooled per set of
+# static options and only the per-job options are swapped in. Progress
+# hooks are fixed at construction; the one installed dispatches to the
+# hook of whichever job is running on the current thread.
+YDL_POOL_IDLE     = int(os.getenv("YDL_POOL_IDLE", DOWNLOAD_WORKERS * 2))
+YDL_POOL_MAX_USES = 200
+YDL_PER_JOB_OPTS  = {"outtmpl", "format", "max_filesize", "progress_hooks"}
+YDL_WARM_EXTRACTORS = ["TikTok", "Instagram", "Facebook", "Twitter", "Generic"]
+
+progress_local = threading.local()
+yt_dlp = None
+
+def load_yt_dlp():
+    """Import yt_dlp on first use (about a second of import time)."""
+    global yt_dlp
+    if yt_dlp is None:
+        start = time.perf_counter()
+        import yt_dlp as module
+        yt_dlp = module
+        logging.info(f"yt_dlp imported in {time.perf_counter() - start:.2f}s")
+    return yt_dlp
+
+def _dispatch_progress(status):
+    hook = getattr(progress_local, "hook", None)
+    if hook:
+        hook(status)
+
+class YdlPool:
+    """Idle YoutubeDL instances keyed by their static options; thread-safe."""
+    def __init__(self, max_idle, max_uses):
+        self.max_idle = max_idle
+        self.max_uses = max_uses
+        self.idle = collections.defaultdict(list)   # key -> [(ydl, uses)]
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(opts):
+        static = {k: v for k, v in opts.items() if k not in YDL_PER_JOB_OPTS}
+        return json.dumps(static, sort_keys=True, default=repr)
+
+    def _create(self, opts):
+        static = {k: v for k, v in opts.items() if k not in YDL_PER_JOB_OPTS}
+        ydl = load_yt_dlp().YoutubeDL(dict(static, progress_hooks=[_dispatch_progress]))
+        for ie_key in YDL_WARM_EXTRACTORS:
+            ydl.get_info_extractor(ie_key)
+        return ydl
+
+    @staticmethod
+    def _configure(ydl, opts):
+        ydl.params["outtmpl"] = opts.get("outtmpl") or {}
+        ydl._parse_outtmpl()
+        fmt = opts.get("format")
+        ydl.params["format"] = fmt
+        ydl.format_selector = fmt if fmt in (None, "-") else ydl.build_format_selector(fmt)
+        ydl.params["max_filesize"] = opts.get("max_filesize")
+
+    @contextlib.contextmanager
+    def get(self, opts):
+        key = self._key(opts)
+        with self.lock:
+            ydl, uses = self.idle[key].pop() if self.idle[key] else (None, 0)
+        if ydl is None:
+            ydl = self._create(opts)
+        self._configure(ydl, opts)
+        try:
+            yield ydl
+        except BaseException:
+            ydl.close()       # state after an aborted job is not trusted
+            raise
+        with self.lock:
+            if uses + 1 < self.max_uses and len(self.idle[key]) < self.max_idle:
+                self.idle[key].append((ydl, uses + 1))
+                return
+        ydl.close()
+
+    def warm(self, opts, count):
+        created = [(self._create(opts), 0) for _ in range(count)]
+        with self.lock:
+            self.idle[self._key(opts)].extend(created)
+
+ydl_pool = YdlPool(YDL_POOL_IDLE, YDL_POOL_MAX_USES)
+
+def _ytdl_download(job):
+    # Runs in a worker thread; the progress hook aborts the transfer on cancel.
+    load_yt_dlp()
+    def check_cancel(_):
+        if job.cancel_event.is_set():
+            raise yt_dlp.utils.DownloadCancelled()
+    progress_local.hook = check_cancel
+    try:
+        with ydl_pool.get(job.opts) as ydl:
+            if job.info:
+                # Same path as --load-info-json: reuse the probe, only select and fetch
+                info = ydl.process_ie_result(yt_dlp.YoutubeDL.sanitize_info(job.info, remove_private_keys=True), download=True)
+            else:
+                info = ydl.extract_info(job.url, download=True)
+            info = info or {}
+    finally:
+        progress_local.hook = None
+    result = {k: info.get(k) for k in ("id", "extractor_key", "title", "duration")}
+    # Final path after merging/post-processing (the extension may differ from outtmpl)
+    downloads = info.get("requested_downloads") or [{}]
+    result["filepath"] = downloads[0].get("filepath")
+    return result
+
+async def wait_for_download(job, status_msg):
+    """Await a job, keeping the user's queue position message up to date."""
+    shown = download_engine.position(job)
+    while True:
+        try:
+            return await asyncio.wait_for(asyncio.shield(job.future), timeout=3)
+        except asyncio.TimeoutError:
+            pos = download_engine.position(job)
+            if pos == shown:
                 continue
-    save_users(users)
+            shown = pos
+            text = "📥 Downloading..." if pos == 0 else f"⏳ Queued (position {pos})..."
+            try:
+                await status_msg.edit_text(text, reply_markup=status_msg.reply_markup)
+            except Exception:
+                pass
+
+def remove_partial_download(filename):
+    # Covers .part files and per-format fragments such as file_x.f137.mp4
+    stem = os.path.splitext(filename)[0]
+    for path in glob.glob(glob.escape(stem) + ".*"):
+        os.remove(path)
 
-def delete_file_later(path, file_id=None):
-    return asyncio.create_task(_delete_file_after_delay(path, file_id))
+download_engine = DownloadEngine(DOWNLOAD_WORKERS, DOWNLOADS_PER_USER, DOWNLOAD_QUEUE_MAX,
+                                 DOWNLOADS_WAITING_PER_USER)
 
-async def _delete_file_after_delay(path, file_id=None):
-    await asyncio.sleep(60)
-    if os.path.exists(path):
-        os.remove(path)
-    if file_id:
-        file_registry.pop(file_id, None)
+
+# --- [FORMAT PROBE] ---
+# extract_info(download=False) runs once per URL (cached briefly because media
+# URLs are signed and expire) so a format that fits UPLOAD_LIMIT can be picked
+# before any bytes are fetched.
+PROBE_CACHE_TTL  = int(os.getenv("PROBE_CACHE_TTL", 600))
+PROBE_CACHE_SIZE = int(os.getenv("PROBE_CACHE_SIZE", 200))
+
+probe_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS * 2, thread_name_prefix="probe")
+probe_cache = collections.OrderedDict()   # normalized URL -> (probed_at, info)
+
+class TooLarge(Exception):
+    pass
+
+PROBE_OPTS = {'quiet': True, 'noplaylist': True}
+
+def _ytdl_probe(url):
+    with ydl_pool.get(PROBE_OPTS) as ydl:
+        return ydl.extract_info(url, download=False)
+
+def warm_ydl_pool():
+    # Startup, in the background: one instance per download worker for each mode
+    try:
+        ydl_pool.warm(PROBE_OPTS, DOWNLOAD_WORKERS)
+        for mode in ("video", "audio"):
+            ydl_pool.warm(ydl_options(mode, "warmup.mp4"), DOWNLOAD_WORKERS)
+    except Exception as e:
+        logging.error(f"yt-dlp pool warm-up failed: {e}")
+
+async def probe_url(url, key):
+    entry = probe_cache.get(key)
+    if entry and time.time() - entry[0] < PROBE_CACHE_TTL:
+        probe_cache.move_to_end(key)
+        return entry[1]
+    info = await asyncio.get_running_loop().run_in_executor(probe_executor, _ytdl_probe, url)
+    probe_cache[key] = (time.time(), info)
+    probe_cache.move_to_end(key)
+    while len(probe_cache) > PROBE_CACHE_SIZE:
+        probe_cache.popitem(last=False)
+    return info
+
+def estimate_size(fmt, duration):
+    size = fmt.get("filesize") or fmt.get("filesize_approx")
+    if not size and fmt.get("tbr") and duration:
+        size = fmt["tbr"] * 1000 / 8 * duration
+    return size
+
+def select_format(info, mode, limit=UPLOAD_LIMIT):
+    """Return a yt-dlp format spec that fits `limit`, or None to let yt-dlp choose.
+
+    Pre-muxed formats win over a video+audio pair (no merge pass). Raises
+    TooLarge when every format with a known size is over the limit.
+    """
+    formats = (info or {}).get("formats") or []
+    duration = info.get("duration") if info else None
+    sized = [(f, estimate_size(f, duration)) for f in formats]
+    sized = [(f, size) for f, size in sized if size]
+    if not sized:
+        return None
+    has_video = lambda f: f.get("vcodec") != "none"
+    has_audio = lambda f: f.get("acodec") != "none"
+    quality = lambda f: (f.get("height") or 0, f.get("tbr") or 0)
+    if mode == "audio":
+        audio = [(f, size) for f, size in sized if has_audio(f) and not has_video(f) and size <= limit]
+        if audio:
+            return max(audio, key=lambda fs: fs[0].get("abr") or fs[0].get("tbr") or 0)[0]["format_id"]
+        if any(has_audio(f) and not has_video(f) for f, _ in sized):
+            raise TooLarge()
+        return None
+
+    muxed = [(f, size) for f, size in sized if has_video(f) and has_audio(f) and size <= limit]
+    if muxed:
+        return max(muxed, key=lambda fs: quality(fs[0]))[0]["format_id"]
+    videos = [(f, size) for f, size in sized if has_video(f) and not has_audio(f)]
+    audios = [(f, size) for f, size in sized if has_audio(f) and not has_video(f)]
+    if audios:
+        audio, audio_size = min(audios, key=lambda fs: fs[1])
+        fitting = [(f, size) for f, size in videos if size + audio_size <= limit]
+        if fitting:
+            video = max(fitting, key=lambda fs: quality(fs[0]))[0]
+            return f"{video['format_id']}+{audio['format_id']}"
+    elif not any(has_audio(f) for f in formats):
+        # No audio track at all: send the best video-only format, as
+        # bestvideo+bestaudio/best would
+        fitting = [(f, size) for f, size in videos if size <= limit]
+        if fitting:
+            return max(fitting, key=lambda fs: quality(fs[0]))[0]["format_id"]
+    raise TooLarge()
+
+
+# --- [MEDIA CACHE] ---
+# Telegram keeps every file we upload; resending its file_id costs nothing.
+MEDIA_CACHE_TTL  = int(os.getenv("MEDIA_CACHE_TTL", 7 * 24 * 3600))
+MEDIA_CACHE_SIZE = int(os.getenv("MEDIA_CACHE_SIZE", 5000))
+TRACKING_PARAMS  = {"fbclid", "gclid", "igshid", "igsh", "si", "s", "t", "ref", "ref_src",
+                    "is_from_webapp", "sender_device", "sender_web_id", "mibextid"}
+HOST_ALIASES     = {"x.com": "twitter.com", "vm.tiktok.com": "tiktok.com", "fb.watch": "facebook.com"}
+
+def normalize_url(url):
+    parts = urllib.parse.urlsplit(url.strip())
+    host = parts.netloc.lower()
+    for prefix in ("www.", "m.", "mobile."):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    host = HOST_ALIASES.get(host, host)
+    query = sorted(
+        (k, v) for k, v in urllib.parse.parse_qsl(parts.query)
+        if k.lower() not in TRACKING_PARAMS and not k.lower().startswith("utm_")
+    )
+    key = host + (parts.path.rstrip("/") or "/")
+    if query:
+        key += "?" + urllib.parse.urlencode(query)
+    return key
+
+def video_id_key(info):
+    if info and info.get("extractor_key") and info.get("id"):
+        return f"{info['extractor_key']}:{info['id']}"
+    return None
+
+class FileIdCache:
+    """Key -> Telegram file_id with LRU eviction and a TTL, persisted in SQLite."""
+    def __init__(self, table, max_entries, ttl):
+        self.table = table
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()     # key -> (file_id, stored_at)
+        self.hits = 0
+        self.misses = 0
+        state_db.execute(f"CREATE TABLE IF NOT EXISTS {table} "
+                         "(key TEXT PRIMARY KEY, file_id TEXT NOT NULL, stored_at REAL NOT NULL)")
+        cutoff = time.time() - ttl
+        rows = state_db.execute(f"SELECT key, file_id, stored_at FROM {table} "
+                                "WHERE stored_at > ? ORDER BY stored_at", (cutoff,)) if not IS_FRONT else ()
+        for key, file_id, stored_at in rows:
+            self.entries[key] = (file_id, stored_at)
+        self._evict()
+
+    def get(self, key, record=True):
+        entry = self.entries.get(key) if key else None
+        if entry is None and key and WORKERS > 1:
+            entry = self._load(key)
+        if entry and time.time() - entry[1] < self.ttl:
+            self.entries.move_to_end(key)
+            self.hits += record
+            return entry[0]
+        if entry:
+            self._drop([key])
+        self.misses += record
+        return None
+
+    def put(self, keys, file_id):
+        now = time.time()
+        rows = []
+        for key in filter(None, keys):
+            self.entries[key] = (file_id, now)
+            self.entries.move_to_end(key)
+            rows.append((key, file_id, now))
+        db_submit(f"INSERT OR REPLACE INTO {self.table} (key, file_id, stored_at) VALUES (?, ?, ?)", rows)
+        self._evict()
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def _load(self, key):
+        # Multi-process mode: another worker may have cached this key
+        row = state_db.execute(f"SELECT file_id, stored_at FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self.entries[key] = tuple(row)
+        self._evict()
+        return self.entries.get(key)
+
+    def _evict(self):
+        excess = len(self.entries) - self.max_entries
+        if excess <= 0:
+            return
+        keys = list(itertools.islice(self.entries, excess))
+        if WORKERS > 1:
+            # Rows are shared; only forget them here and let prune() trim the table
+            for key in keys:
+                self.entries.pop(key, None)
+        else:
+            self._drop(keys)
+
+    def _drop(self, keys):
+        for key in keys:
+            self.entries.pop(key, None)
+        db_submit(f"DELETE FROM {self.table} WHERE key = ?", [(k,) for k in keys])
+
+    def prune(self):
+        """Trim the shared table to its TTL and size cap (primary only in multi-process mode)."""
+        if WORKERS == 1 or not IS_PRIMARY:
+            return
+        db_submit(f"DELETE FROM {self.table} WHERE stored_at < ?", [(time.time() - self.ttl,)])
+        db_submit(f"DELETE FROM {self.table} WHERE key NOT IN "
+                  f"(SELECT key FROM {self.table} ORDER BY stored_at DESC LIMIT ?)", [(self.max_entries,)])
+
+media_cache = FileIdCache("media_cache", MEDIA_CACHE_SIZE, MEDIA_CACHE_TTL)
+remote_files = TTLMap("remote_files", ttl=24 * 3600, max_entries=20000)   # placeholder path -> (file_id, source URL) of a cache-served video
+
+# Single-flight: the first request for a URL downloads and uploads it, while
+# concurrent requests for the same normalized URL await the resulting file_id.
+inflight_videos = {}   # normalized URL -> Future[file_id]
+FLIGHT_WAIT_TIMEOUT = float(os.getenv("FLIGHT_WAIT_TIMEOUT", 900))   # how long a waiter trusts the leader
+
+def resolve_flight(flight, file_id=None, error=None):
+    if flight.done():
+        return
+    if error is None:
+        flight.set_result(file_id)
+    else:
+        flight.set_exception(error)
+        flight.exception()   # mark retrieved so a flight without waiters doesn't warn
+
+async def fetch_remote_file(bot, path, owner):
+    """Re-download a cache-served video so it can be converted.
+
+    Bots can only fetch files up to 20 MB from Telegram; larger ones are
+    downloaded from the source URL again.
+    """
+    entry = remote_files.get(path)
+    if not entry:
+        return False
+    file_id, url = entry
+    try:
+        tg_file = await bot.get_file(file_id)
+        await tg_file.download_to_drive(path)
+        janitor.touch(path)
+        return True
+    except Exception as e:
+        logging.warning(f"fetch_remote_file: getFile failed ({e}), downloading the source")
+    opts = ydl_options("video", path)
+    if COMPRESS_OVERSIZE:
+        opts['max_filesize'] = COMPRESS_SOURCE_MAX
+    try:
+        await download_engine.submit(owner, url, opts).future
+    except Exception as e:
+        logging.error(f"fetch_remote_file error: {e}")
+        remove_partial_download(path)
+        return False
+    return os.path.exists(path)
 
 
 # --- [NOWPAYMENTS INTEGRATION] ---
+INVOICE_TTL          = 20 * 60     # unpaid invoices are cancelled after 20 minutes
+INVOICE_CANCEL_BATCH = 10
+
+class NowPaymentsClient:
+    """One keep-alive session for every NowPayments call, with timeouts and retries.
+
+    `base_url` can point at a local fake server for testing.
+    """
+    def __init__(self, base_url, api_key, timeout=15, retries=3):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.session = None
+
+    def _session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=20, keepalive_timeout=60),
+                timeout=self.timeout,
+                headers={"x-api-key": self.api_key or ""}
+            )
+        return self.session
+
+    async def request(self, method, path, **kwargs):
+        idempotent = method in ("GET", "DELETE")
+        for attempt in range(self.retries):
+            try:
+                async with self._session().request(method, self.base_url + path, **kwargs) as resp:
+                    if resp.status >= 500 or resp.status == 429:
+                        raise aiohttp.ClientResponseError(resp.request_info, resp.history, status=resp.status)
+                    return await resp.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # A timed-out or failed POST may still have created an invoice; only
+                # retry it when the request never reached the server or was rate limited
+                retryable = (idempotent or isinstance(e, aiohttp.ClientConnectorError)
+                             or getattr(e, "status", None) == 429)
+                if not retryable or attempt == self.retries - 1:
+                    raise
+                logging.warning(f"NowPayments {method} {path} failed ({e}); retrying")
+                await asyncio.sleep(0.5 * 2 ** attempt)
+
+    async def create_invoice(self, payload):
+        return await self.request("POST", "/invoice", json=payload)
+
+    async def cancel_invoice(self, inv_id):
+        return await self.request("DELETE", f"/invoice/{inv_id}")
+
+    async def close(self):
+        if self.session and not self.session.closed:
+            await self.session.close()
+
+nowpayments = NowPaymentsClient(NOW_API_URL, NOW_API_KEY)
+
+# pending_invoices is mirrored in the invoices table so unpaid invoices are
+# still cancelled (and paid ones still matched) after a restart.
+state_db.execute("CREATE TABLE IF NOT EXISTS invoices (id TEXT PRIMARY KEY, username TEXT NOT NULL, "
+                 "amount REAL NOT NULL, deadline REAL NOT NULL)")
+invoice_deadlines = {}   # invoice id -> unix time after which it is cancelled
+pending_invoices = TTLMap("pending_invoices", ttl=2 * INVOICE_TTL, max_entries=10000)   # id -> (username, amount)
+# A single process adopts every invoice left by its previous run. With
+# several workers each tracks the invoices it creates, and the primary only
+# adopts those still open INVOICE_ADOPT_GRACE past their deadline, i.e.
+# whose worker went away before cancelling them.
+INVOICE_ADOPT_GRACE = 5 * 60
+
+def adopt_invoices(cutoff):
+    for inv_id, username, amount, deadline in state_db.execute(
+            "SELECT id, username, amount, deadline FROM invoices WHERE deadline < ?", (cutoff,)):
+        if inv_id not in invoice_deadlines:
+            pending_invoices[inv_id] = (username, amount)
+            invoice_deadlines[inv_id] = deadline
+
+if WORKERS == 1:
+    adopt_invoices(float("inf"))
+
+def lookup_invoice(inv_id):
+    if inv_id in pending_invoices:
+        return pending_invoices[inv_id]
+    row = state_db.execute("SELECT username, amount FROM invoices WHERE id = ?", (inv_id,)).fetchone()
+    return tuple(row) if row else None
+
+def forget_invoice(inv_id):
+    pending_invoices.pop(inv_id, None)
+    invoice_deadlines.pop(inv_id, None)
+    db_submit("DELETE FROM invoices WHERE id = ?", [(inv_id,)])
+
 async def create_invoice(username, amount):
-    """Create NowPayments invoice and schedule auto-cancel in 20m."""
-    url = "https://api.nowpayments.io/v1/invoice"
-    headers = {"x-api-key": NOW_API_KEY, "Content-Type": "application/json"}
+    """Create NowPayments invoice; invoice_scheduler() cancels it after INVOICE_TTL."""
     order_id = f"{username}:{amount}:{uuid.uuid4()}"
     payload = {
         "price_amount": amount,
@@ -125,29 +1560,47 @@ async def create_invoice(username, amount):
         "ipn_callback_url": f"{APP_URL}/ipn",
         "success_url": CHANNEL_URL
     }
-    async with aiohttp.ClientSession() as session:
-        resp = await session.post(url, headers=headers, json=payload)
-        data = await resp.json()
-    inv_id = data.get("id")
+    data = await nowpayments.create_invoice(payload)
+    if not data.get("id"):
+        logging.error(f"NowPayments invoice error: {data}")
+        return data
+    inv_id = str(data["id"])
+    deadline = time.time() + INVOICE_TTL
     pending_invoices[inv_id] = (username, amount)
-    # schedule cancellation if unpaid
-    asyncio.create_task(cancel_invoice_later(inv_id))
+    invoice_deadlines[inv_id] = deadline
+    db_submit("INSERT OR REPLACE INTO invoices (id, username, amount, deadline) VALUES (?, ?, ?, ?)",
+              [(inv_id, username, amount, deadline)])
     return data
 
-async def cancel_invoice_later(inv_id):
-    await asyncio.sleep(20 * 60)  # 20 minutes
-    url = f"https://api.nowpayments.io/v1/invoice/{inv_id}"
-    headers = {"x-api-key": NOW_API_KEY}
-    async with aiohttp.ClientSession() as session:
-        await session.delete(url, headers=headers)
+async def _cancel_invoice(inv_id):
+    if not state_db.execute("SELECT 1 FROM invoices WHERE id = ?", (inv_id,)).fetchone():
+        # Already paid through another worker
+        return forget_invoice(inv_id)
+    try:
+        await nowpayments.cancel_invoice(inv_id)
+    except Exception as e:
+        logging.error(f"Cancelling invoice {inv_id} failed: {e}")
+    forget_invoice(inv_id)
+
+async def invoice_scheduler():
+    while True:
+        now = time.time()
+        if WORKERS > 1 and IS_PRIMARY:
+            adopt_invoices(now - INVOICE_ADOPT_GRACE)
+        due = [inv_id for inv_id, deadline in invoice_deadlines.items() if deadline <= now]
+        for i in range(0, len(due), INVOICE_CANCEL_BATCH):
+            await asyncio.gather(*[_cancel_invoice(inv_id) for inv_id in due[i:i + INVOICE_CANCEL_BATCH]])
+        upcoming = min(invoice_deadlines.values(), default=now + 60)
+        await asyncio.sleep(min(max(upcoming - time.time(), 1), 60))
 
 async def ipn_handler(request):
     data = await request.json()
     if data.get("ipn_secret") != NOW_IPN_SECRET:
         return web.Response(text="invalid secret", status=400)
     if data.get("payment_status") == "finished":
-        inv_id = data.get("invoice_id")
-        tup = pending_invoices.pop(inv_id, None)
+        inv_id = str(data.get("invoice_id"))
+        tup = lookup_invoice(inv_id)
+        forget_invoice(inv_id)
         if tup:
             username, amount = tup
         else:
@@ -157,25 +1610,395 @@ async def ipn_handler(request):
         exp = datetime.utcnow() + timedelta(days=days)
         users[username]["plan"] = "premium"
         users[username]["expires"] = exp.isoformat()
-        save_users(users)
+        index_expiry(username)
+        save_user(username)
+        # Answer only once the grant is on disk; NowPayments retries on errors
+        if not await flush_users():
+            return web.Response(text="store unavailable", status=500)
     return web.Response(text="ok")
 
 
+# --- [BROADCAST ENGINE] ---
+# Broadcasts run as background jobs. A token bucket keeps sends under
+# Telegram's global limit (~30 msg/s), each chat gets at most one message per
+# BROADCAST_CHAT_INTERVAL, and RetryAfter pauses every sender. Per-recipient
+# progress is persisted so a restart resumes where the job stopped.
+BROADCAST_RATE        = float(os.getenv("BROADCAST_RATE", 25))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 20))
+BROADCAST_CHAT_INTERVAL = 1.0
+BROADCAST_PROGRESS_INTERVAL = 3.0
+PENDING, SENT, FAILED = 0, 1, 2
+
+state_db.execute("CREATE TABLE IF NOT EXISTS broadcasts (id TEXT PRIMARY KEY, text TEXT NOT NULL, "
+                 "admin_chat INTEGER, status_message INTEGER, state TEXT NOT NULL, created REAL NOT NULL)")
+state_db.execute("CREATE TABLE IF NOT EXISTS broadcast_targets (job_id TEXT NOT NULL, chat_id INTEGER NOT NULL, "
+                 "state INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (job_id, chat_id))")
+# The process running a job refreshes its heartbeat; the primary resumes
+# only jobs whose heartbeat is older than BROADCAST_STALE (owner gone).
+state_db.execute("DELETE FROM broadcast_targets WHERE job_id IN (SELECT id FROM broadcasts WHERE state = 'done')")
+if "heartbeat" not in {row[1] for row in state_db.execute("PRAGMA table_info(broadcasts)")}:
+    state_db.execute("ALTER TABLE broadcasts ADD COLUMN owner TEXT")
+    state_db.execute("ALTER TABLE broadcasts ADD COLUMN heartbeat REAL NOT NULL DEFAULT 0")
+BROADCAST_STALE = 30
+PROCESS_ID = f"{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        # Go into debt so nobody sends until the flood wait has passed
+        self.tokens = min(self.tokens, -seconds * self.rate)
+        self.updated = time.monotonic()
+
+broadcast_bucket = TokenBucket(BROADCAST_RATE)
+chat_next_send = {}          # chat id -> monotonic time the chat may be messaged again
+broadcast_tasks = {}         # job id -> asyncio.Task
+
+class BroadcastJob:
+    def __init__(self, job_id, text, admin_chat, status_message, pending, sent=0, failed=0):
+        self.id = job_id
+        self.text = text
+        self.admin_chat = admin_chat
+        self.status_message = status_message
+        self.pending = pending
+        self.total = len(pending) + sent + failed
+        self.sent = sent
+        self.failed = failed
+        self.unsaved = []    # (state, job id, chat id) not yet written
+
+    def record(self, chat_id, ok):
+        if ok:
+            self.sent += 1
+        else:
+            self.failed += 1
+        self.unsaved.append((SENT if ok else FAILED, self.id, chat_id))
+
+    def save_progress(self):
+        rows, self.unsaved = self.unsaved, []
+        if rows:
+            return db_submit("UPDATE broadcast_targets SET state = ? WHERE job_id = ? AND chat_id = ?", rows)
+
+def retry_after_seconds(error):
+    delay = error.retry_after
+    return delay.total_seconds() if isinstance(delay, timedelta) else float(delay)
+
+async def send_broadcast_message(bot, chat_id, text):
+    for attempt in range(4):
+        wait = chat_next_send.get(chat_id, 0) - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        await broadcast_bucket.acquire()
+        chat_next_send[chat_id] = time.monotonic() + BROADCAST_CHAT_INTERVAL
+        try:
+            await bot.send_message(chat_id=chat_id, text=text)
+            return True
+        except RetryAfter as e:
+            delay = retry_after_seconds(e)
+            broadcast_bucket.pause(delay)
+            await asyncio.sleep(delay)
+        except (Forbidden, BadRequest):
+            return False     # blocked the bot, deleted account, bad chat id
+        except NetworkError:
+            await asyncio.sleep(2 ** attempt)
+        except Exception as e:
+            logging.error(f"Broadcast to {chat_id} failed: {e}")
+            return False
+    return False
+
+async def report_broadcast(bot, job, final=False):
+    if final:
+        text = f"✅ Broadcast sent to {job.sent} users ({job.failed} failed)."
+    else:
+        text = f"📣 Broadcasting... {job.sent + job.failed}/{job.total} (sent {job.sent}, failed {job.failed})"
+    try:
+        await bot.edit_message_text(text, chat_id=job.admin_chat, message_id=job.status_message)
+    except Exception:
+        pass
+
+async def run_broadcast(bot, job):
+    queue = collections.deque(job.pending)
+
+    async def sender():
+        while queue:
+            chat_id = queue.popleft()
+            job.record(chat_id, await send_broadcast_message(bot, chat_id, job.text))
+
+    async def progress():
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            job.save_progress()
+            db_submit("UPDATE broadcasts SET heartbeat = ? WHERE id = ? AND owner = ?",
+                      [(time.time(), job.id, PROCESS_ID)])
+            await report_broadcast(bot, job)
+
+    reporter = asyncio.create_task(progress())
+    try:
+        await asyncio.gather(*[sender() for _ in range(BROADCAST_CONCURRENCY)])
+    finally:
+        reporter.cancel()
+        saved = job.save_progress()
+        if saved:
+            await asyncio.wrap_future(saved)
+    await asyncio.wrap_future(db_submit("UPDATE broadcasts SET state = 'done' WHERE id = ?", [(job.id,)]))
+    # Per-recipient progress is only needed to resume a running job
+    db_submit("DELETE FROM broadcast_targets WHERE job_id = ?", [(job.id,)])
+    broadcast_tasks.pop(job.id, None)
+    now = time.monotonic()
+    for chat_id in [c for c, t in chat_next_send.items() if t < now]:
+        del chat_next_send[chat_id]
+    await report_broadcast(bot, job, final=True)
+
+async def start_broadcast(bot, text, admin_chat, status_message):
+    recipients = list(dict.fromkeys(
+        data["user_id"] for data in users.values()
+        if data.get("user_id") and not data.get("banned")
+    ))
+    job = BroadcastJob(uuid.uuid4().hex[:12], text, admin_chat, status_message, recipients)
+    await asyncio.wrap_future(db_submit(
+        "INSERT INTO broadcasts (id, text, admin_chat, status_message, state, created, owner, heartbeat) "
+        "VALUES (?, ?, ?, ?, 'running', ?, ?, ?)",
+        [(job.id, text, admin_chat, status_message, time.time(), PROCESS_ID, time.time())]
+    ))
+    await asyncio.wrap_future(db_submit(
+        "INSERT OR IGNORE INTO broadcast_targets (job_id, chat_id) VALUES (?, ?)",
+        [(job.id, chat_id) for chat_id in recipients]
+    ))
+    broadcast_tasks[job.id] = asyncio.create_task(run_broadcast(bot, job))
+    return job
+
+def _claim_broadcasts(cutoff):
+    # Runs on the db thread: take over running jobs whose owner stopped beating
+    with state_db:
+        state_db.execute("BEGIN IMMEDIATE")
+        jobs = state_db.execute("SELECT id, text, admin_chat, status_message FROM broadcasts "
+                                "WHERE state = 'running' AND heartbeat < ?", (cutoff,)).fetchall()
+        state_db.executemany("UPDATE broadcasts SET owner = ?, heartbeat = ? WHERE id = ?",
+                             [(PROCESS_ID, time.time(), job[0]) for job in jobs])
+    return jobs
+
+async def resume_broadcasts(bot):
+    jobs = await asyncio.get_running_loop().run_in_executor(
+        db_executor, _claim_broadcasts, time.time() - BROADCAST_STALE)
+    for job_id, text, admin_chat, status_message in jobs:
+        if job_id in broadcast_tasks:
+            continue
+        counts = dict(state_db.execute(
+            "SELECT state, COUNT(*) FROM broadcast_targets WHERE job_id = ? GROUP BY state", (job_id,)))
+        pending = [row[0] for row in state_db.execute(
+            "SELECT chat_id FROM broadcast_targets WHERE job_id = ? AND state = ?", (job_id, PENDING))]
+        job = BroadcastJob(job_id, text, admin_chat, status_message, pending,
+                           counts.get(SENT, 0), counts.get(FAILED, 0))
+        broadcast_tasks[job_id] = asyncio.create_task(run_broadcast(bot, job))
+        logging.info(f"Resumed broadcast {job_id}: {len(pending)} recipients left")
+
+async def broadcast_adopter(bot):
+    # Primary only: pick up jobs left by a worker that stopped
+    while True:
+        await asyncio.sleep(BROADCAST_STALE)
+        if not application.running:
+            continue
+        try:
+            await resume_broadcasts(bot)
+        except Exception as e:
+            logging.error(f"Resuming broadcasts failed: {e}")
+
+
+# --- [CONVERSION SERVICE] ---
+# All transcodes go through convert(): ffmpeg runs as an asyncio subprocess,
+# at most FFMPEG_CONCURRENCY at a time, and is killed on timeout or cancel.
+FFMPEG_BIN         = os.getenv("FFMPEG_BIN", "ffmpeg")
+FFMPEG_CONCURRENCY = int(os.getenv("FFMPEG_CONCURRENCY", os.cpu_count() or 1))
+FFMPEG_TIMEOUT     = float(os.getenv("FFMPEG_TIMEOUT", 120))
+
+CONVERSION_PROFILES = {
+    # name: (output extension, input options, output options)
+    "audio": ("mp3", [], ["-vn", "-codec:a", "libmp3lame", "-q:a", "2"]),
+    "gif":   ("gif", ["-ss", "0", "-t", "10"], ["-vf", "fps=10,scale=320:-1"]),   # first 10 seconds
+}
+
+class ConversionError(Exception):
+    pass
+
+ffmpeg_slots = asyncio.Semaphore(FFMPEG_CONCURRENCY)
+
+ffmpeg_running = 0
+
+async def run_ffmpeg(args, timeout=FFMPEG_TIMEOUT):
+    global ffmpeg_running
+    async with ffmpeg_slots:
+        start = time.perf_counter()
+        proc = await asyncio.create_subprocess_exec(
+            FFMPEG_BIN, "-hide_banner", "-loglevel", "error", "-y", *args,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+        ffmpeg_running += 1
+        try:
+            _, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            proc.kill()
+            await proc.wait()
+            raise
+        finally:
+            ffmpeg_running -= 1
+            ffmpeg_seconds.observe(time.perf_counter() - start)
+    if proc.returncode != 0:
+        raise ConversionError(stderr.decode(errors="replace").strip()[-500:])
+
+async def convert(source, profile, output=None):
+    """Transcode `source` with a named profile and return the output path."""
+    ext, input_opts, output_opts = CONVERSION_PROFILES[profile]
+    output = output or f"conv_{uuid.uuid4().hex}.{ext}"
+    try:
+        await run_ffmpeg([*input_opts, "-i", source, *output_opts, output])
+    except BaseException:
+        if os.path.exists(output):
+            os.remove(output)
+        raise
+    return output
+
+
+# --- [TARGET-SIZE COMPRESSION] ---
+# Videos over UPLOAD_LIMIT are re-encoded with a bitrate computed from their
+# duration so the result fits, instead of being dropped.
+COMPRESS_OVERSIZE    = os.getenv("COMPRESS_OVERSIZE", "1") == "1"
+COMPRESS_SOURCE_MAX  = int(os.getenv("COMPRESS_SOURCE_MAX_MB", 300)) * 1024 * 1024
+COMPRESS_MODE        = os.getenv("COMPRESS_MODE", "twopass")     # "twopass" or "crf" (two-pass if over)
+COMPRESS_PRESET      = os.getenv("COMPRESS_PRESET", "veryfast")
+COMPRESS_TIMEOUT     = float(os.getenv("COMPRESS_TIMEOUT", 900))
+COMPRESS_AUDIO_KBPS  = 96
+COMPRESS_MIN_VIDEO_KBPS = 150      # below this the result isn't worth sending
+
+def compression_plan(duration, target_bytes):
+    """Return (video kbps, max height) for a clip of `duration` seconds, or None."""
+    if not duration:
+        return None
+    total_kbps = target_bytes * 8 / 1000 / duration * 0.95   # 5% container/rate-control margin
+    video_kbps = int(total_kbps - COMPRESS_AUDIO_KBPS)
+    if video_kbps < COMPRESS_MIN_VIDEO_KBPS:
+        return None
+    height = 480 if video_kbps < 900 else 720 if video_kbps < 2500 else 1080
+    return video_kbps, height
+
+async def compress_to_size(source, target_bytes, duration, mode=COMPRESS_MODE, preset=COMPRESS_PRESET):
+    plan = compression_plan(duration, target_bytes)
+    if plan is None:
+        raise TooLarge()
+    video_kbps, height = plan
+    output = f"conv_{uuid.uuid4().hex}.mp4"
+    passlog = f"conv_{uuid.uuid4().hex}_pass"
+    threads = str(max(1, (os.cpu_count() or 1) // FFMPEG_CONCURRENCY))
+    video_opts = [
+        "-vf", f"scale=-2:'min({height},ih)'", "-c:v", "libx264", "-preset", preset,
+        "-threads", threads, "-pix_fmt", "yuv420p"
+    ]
+    audio_opts = ["-c:a", "aac", "-b:a", f"{COMPRESS_AUDIO_KBPS}k", "-movflags", "+faststart"]
+    try:
+        if mode == "crf":
+            await run_ffmpeg(["-i", source, *video_opts, "-crf", "23",
+                              "-maxrate", f"{video_kbps}k", "-bufsize", f"{video_kbps * 2}k",
+                              *audio_opts, output], timeout=COMPRESS_TIMEOUT)
+            if os.path.getsize(output) > target_bytes:
+                # -maxrate only caps the peak rate, not the size; redo it in two passes
+                logging.info(f"CRF output over {target_bytes} bytes; retrying with two-pass")
+                os.remove(output)
+                mode = "twopass"
+        if mode != "crf":
+            rate = ["-b:v", f"{video_kbps}k", "-passlogfile", passlog]
+            await run_ffmpeg(["-i", source, *video_opts, *rate, "-pass", "1", "-an", "-f", "null", os.devnull],
+                             timeout=COMPRESS_TIMEOUT)
+            await run_ffmpeg(["-i", source, *video_opts, *rate, "-pass", "2", *audio_opts, output],
+                             timeout=COMPRESS_TIMEOUT)
+        if os.path.getsize(output) > target_bytes:
+            raise TooLarge()
+    except BaseException:
+        if os.path.exists(output):
+            os.remove(output)
+        raise
+    finally:
+        for path in glob.glob(glob.escape(passlog) + "*"):
+            os.remove(path)
+    return output
+
+
+# --- [CONVERSION CACHE] ---
+# Content-addressed: the key is the source file's SHA-256 plus the profile's
+# parameters, so the same clip converted by any user is transcoded once.
+CONVERSION_CACHE_SIZE = int(os.getenv("CONVERSION_CACHE_SIZE", 2000))
+CONVERSION_CACHE_TTL  = int(os.getenv("CONVERSION_CACHE_TTL", 7 * 24 * 3600))
+
+conversion_cache = FileIdCache("conversion_cache", CONVERSION_CACHE_SIZE, CONVERSION_CACHE_TTL)
+source_digests = {}   # path -> ((size, device, inode), sha256 hex)
+
+def _sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+async def conversion_key(source, profile):
+    # Not mtime: the janitor bumps it on every use. Media files are never
+    # rewritten in place (compression os.replace()s them), so a new inode
+    # means new content.
+    st = os.stat(source)
+    stamp = (st.st_size, st.st_dev, st.st_ino)
+    known = source_digests.get(source)
+    if not known or known[0] != stamp:
+        digest = await asyncio.get_running_loop().run_in_executor(None, _sha256_file, source)
+        known = source_digests[source] = (stamp, digest)
+    params = hashlib.sha256(repr(CONVERSION_PROFILES[profile]).encode()).hexdigest()[:12]
+    return f"{known[1]}:{profile}:{params}"
+
+async def send_conversion(message, source, profile, filename):
+    """Reply with `source` converted by `profile`, reusing a cached upload if any."""
+    record_daily("conversions")
+    key = await conversion_key(source, profile)
+    reply = message.reply_audio if profile == "audio" else message.reply_document
+    cached_id = conversion_cache.get(key)
+    if cached_id:
+        return await reply(cached_id, filename=filename)
+    output = await convert(source, profile)
+    try:
+        with open(output, "rb") as f, upload_seconds.time():
+            sent = await reply(f, filename=filename)
+    finally:
+        os.remove(output)
+    media = sent.audio if profile == "audio" else sent.document
+    if media:
+        conversion_cache.put([key], media.file_id)
+    return sent
+
+
 # --- [AUDIO CONVERSION] ---
 async def convert_to_audio(update: Update, context: ContextTypes.DEFAULT_TYPE, file_path):
-    audio_path = file_path.replace(".mp4", ".mp3")
+    audio_name = os.path.basename(file_path).replace(".mp4", ".mp3")
     try:
-        ffmpeg.input(file_path).output(audio_path).run(overwrite_output=True)
-        with open(audio_path, 'rb') as f:
-            await update.callback_query.message.reply_audio(f, filename=os.path.basename(audio_path))
-        os.remove(audio_path)
-    except:
+        await send_conversion(update.callback_query.message, file_path, "audio", audio_name)
+    except Exception as e:
+        handler_failed()
+        logging.error(f"convert_to_audio error: {e}")
         await update.callback_query.message.reply_text("❌ Failed to convert to audio.")
 
 
 # --- [START HANDLER] ---
+@instrumented
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    downgrade_expired_users()
     user = update.effective_user
     username = user.username or f"user_{user.id}"
     user_id = user.id
@@ -188,17 +2011,18 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "video_gif_trial": False,
             "user_id": user_id
         }
-        save_users(users)
-    else:
+        save_user(username)
+    elif users[username].get("user_id") != user_id:
         users[username]["user_id"] = user_id
-        save_users(users)
+        save_user(username)
     if users[username].get("banned"):
         return await update.message.reply_text("⛔ You are banned from using this bot.")
     buttons = [
         [InlineKeyboardButton("👤 View Profile", callback_data="profile"),
          InlineKeyboardButton("🖼️ Convert to PDF", callback_data="convertpdf_btn")],
         [InlineKeyboardButton("💳 Upgrade Your Plan", callback_data="upgrade_plan")],
-        [InlineKeyboardButton("✉️ Text to PDF", callback_data="text_pdf")],
+        [InlineKeyboardButton("✉️ Text to PDF", callback_data="text_pdf"),
+         InlineKeyboardButton("🎵 Audio Only", callback_data="audio_only")],
         [InlineKeyboardButton("📣 Join Our Channel", url=CHANNEL_URL)]
     ]
     if user.id == ADMIN_ID:
@@ -213,9 +2037,72 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=InlineKeyboardMarkup(buttons)
     )
 
+def video_buttons(filename):
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("🎧 Convert to Audio", callback_data=f"audio:{filename}"),
+            InlineKeyboardButton("🎞️ Convert to GIF", callback_data=f"gif:{filename}")
+        ]
+    ])
+
+def sent_file_id(message):
+    media = message.video or message.animation or message.document or message.audio
+    return media.file_id if media else None
+
+def count_download(username, user_data):
+    record_daily("downloads")
+    if not is_premium(user_data, username):
+        user_data["downloads"] += 1
+        users[username] = user_data
+        save_user(username)
+
+def ydl_options(mode, filename):
+    if mode == "audio":
+        # Best audio-only stream; FFmpegExtractAudio with "best" copies the
+        # codec out of its container instead of re-encoding when it can.
+        return {
+            'outtmpl': os.path.splitext(filename)[0] + '.%(ext)s',
+            'format': 'bestaudio[ext=m4a]/bestaudio/best',
+            'postprocessors': [{'key': 'FFmpegExtractAudio', 'preferredcodec': 'best'}],
+            'quiet': True,
+            'noplaylist': True,
+            'max_filesize': UPLOAD_LIMIT
+        }
+    return {
+        'outtmpl': filename,
+        'format': 'bestvideo+bestaudio/best',
+        'merge_output_format': 'mp4',
+        'quiet': True,
+        'noplaylist': True,
+        'max_filesize': UPLOAD_LIMIT
+    }
+
+async def reply_media(message, mode, media, filename):
+    if mode == "audio":
+        return await message.reply_audio(media, caption="🎧 Here's your audio!", filename=os.path.basename(filename))
+    return await message.reply_video(media, caption="🎉 Here's your video!", reply_markup=video_buttons(filename))
+
+async def send_cached_media(update, mode, file_id, url, filename, username, user_data):
+    sent = await reply_media(update.message, mode, file_id, filename)
+    if mode == "video":
+        remote_files[filename] = (file_id, url)
+        file_registry[sent.message_id] = filename
+        track_media(filename, sent.message_id)
+    count_download(username, user_data)
+
+@instrumented
 async def handle_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    downgrade_expired_users()
-    url = update.message.text.strip()
+    mode = "audio" if context.user_data.pop("awaiting_audio", False) else "video"
+    await deliver_link(update, context, update.message.text.strip(), mode)
+
+@instrumented
+async def audio_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if context.args:
+        return await deliver_link(update, context, context.args[0].strip(), "audio")
+    context.user_data["awaiting_audio"] = True
+    await update.message.reply_text("🎵 Send me the link you want as audio only.")
+
+async def deliver_link(update: Update, context: ContextTypes.DEFAULT_TYPE, url, mode="video"):
     if not is_valid_url(url):
         await update.message.reply_text("❌ Invalid URL or unsupported platform.")
         return
@@ -224,63 +2111,198 @@ async def handle_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     user = update.effective_user
-    username = user.username
+    username = user.username or f"user_{user.id}"
     # Ban check
     if username and users.get(username, {}).get("banned"):
         return await update.message.reply_text("⛔ You are banned from using this bot.")
 
     user_data = users.get(username, {"plan": "free", "downloads": 0})
-    if not is_premium(user_data) and user_data["downloads"] >= 3:
+    if not is_premium(user_data, username) and user_data["downloads"] >= 3:
         await update.message.reply_text("⛔ Free users are limited to 3 downloads. Upgrade to continue.")
         return
 
     filename = generate_filename()
-    status_msg = await update.message.reply_text("📥 Downloading...")
-    ydl_opts = {
-        'outtmpl': filename,
-        'format': 'bestvideo+bestaudio/best',
-        'merge_output_format': 'mp4',
-        'quiet': True,
-        'noplaylist': True,
-        'max_filesize': 70 * 1024 * 1024
-    }
+    url_key = normalize_url(url)
+    if mode == "audio":
+        url_key = "audio|" + url_key
+    cached_id = media_cache.get(url_key)
+    leader = inflight_videos.get(url_key)
+    if not cached_id and leader:
+        # Someone is already fetching this link: wait for their upload
+        release_lane()
+        status_msg = await update.message.reply_text("📥 Downloading...")
+        failed = False
+        try:
+            cached_id = await asyncio.wait_for(asyncio.shield(leader), FLIGHT_WAIT_TIMEOUT)
+        except DownloadCancelled:
+            pass    # the leader gave up; fetch it ourselves below
+        except asyncio.TimeoutError:
+            failed = True
+            await update.message.reply_text("❌ The download took too long. Please try again later.")
+        except TooLarge:
+            failed = True
+            await update.message.reply_text(f"❌ This file is larger than {UPLOAD_LIMIT // (1024 * 1024)} MB and can't be sent.")
+        except Exception as e:
+            failed = True
+            handler_failed()
+            logging.error(f"handle_video error (coalesced): {e}")
+            await update.message.reply_text("❌ Download failed. Please check the link or try again later.")
+        try:
+            await status_msg.delete()
+        except:
+            pass
+        if failed:
+            return
+    if cached_id:
+        # Telegram already has this file: resend it without downloading
+        return await send_cached_media(update, mode, cached_id, url, filename, username, user_data)
+    if url_key in inflight_videos:
+        # Another waiter took over after the previous leader was cancelled
+        return await deliver_link(update, context, url, mode)
+
+    # Claim a download slot before probing, so the limits apply up front. A
+    # link sent while the user's previous one is still downloading waits for
+    # it (the lane is released so its Cancel button keeps working).
+    status_msg = None
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
-        with open(filename, 'rb') as f:
-            sent = await update.message.reply_video(
-                f,
-                caption="🎉 Here's your video!",
-                reply_markup=InlineKeyboardMarkup([
-                    [
-                        InlineKeyboardButton("🎧 Convert to Audio", callback_data=f"audio:{filename}"),
-                        InlineKeyboardButton("🎞️ Convert to GIF", callback_data=f"gif:{filename}")
-                    ]
-                ])
-            )
-        file_registry[sent.message_id] = filename
-        # Schedule deletion without nested create_task
-        delete_file_later(filename, sent.message_id)
-        await status_msg.delete()
-        if not is_premium(user_data):
-            user_data["downloads"] += 1
-            users[username] = user_data
-            save_users(users)
-    except Exception as e:
-        # Delete the "Downloading…" message if still present
+        if download_engine.must_wait(user.id):
+            status_msg = await update.message.reply_text("⏳ Queued behind your current download...")
+            release_lane()
+        await download_engine.reserve_in_turn(user.id)
+    except (DownloadLimitReached, DownloadQueueFull) as e:
+        if isinstance(e, DownloadQueueFull):
+            text = "🚦 The bot is busy right now. Please try again in a minute."
+        else:
+            text = (f"⏳ You already have {DOWNLOADS_WAITING_PER_USER} links waiting. "
+                    "Please send this one again once they're done.")
+        if status_msg:
+            return await status_msg.edit_text(text)
+        return await update.message.reply_text(text)
+    if status_msg and (url_key in inflight_videos or media_cache.get(url_key, record=False)):
+        # Fetched or started by someone else while this link waited
+        download_engine.unreserve(user.id)
         try:
             await status_msg.delete()
         except:
             pass
-        # Only log the exception; do not send a warning for every download
+        return await deliver_link(update, context, url, mode)
+    reserved = True
+    flight = asyncio.get_running_loop().create_future()
+    inflight_videos[url_key] = flight
+    file_id = None
+    try:
+        # Inside the try so a failed reply still resolves and unregisters the flight
+        if status_msg:
+            status_msg = await status_msg.edit_text("📥 Downloading...")
+        else:
+            status_msg = await update.message.reply_text("📥 Downloading...")
+        release_lane()
+        probe = await probe_url(url, normalize_url(url))
+        id_key = video_id_key(probe)
+        if id_key and mode == "audio":
+            id_key = "audio|" + id_key
+        cached_id = media_cache.get(id_key, record=False) if id_key else None
+        if cached_id:
+            # Different link, same video: Telegram already has it. The URL
+            # lookup above already counted a miss; count it as a hit instead.
+            media_cache.misses -= 1
+            media_cache.hits += 1
+            await status_msg.delete()
+            await send_cached_media(update, mode, cached_id, url, filename, username, user_data)
+            media_cache.put([url_key], cached_id)
+            return resolve_flight(flight, cached_id)
+        opts = ydl_options(mode, filename)
+        if mode == "video" and COMPRESS_OVERSIZE:
+            # Sizes may be unknown until the download starts; anything over
+            # UPLOAD_LIMIT but under COMPRESS_SOURCE_MAX is compressed below
+            opts['max_filesize'] = COMPRESS_SOURCE_MAX
+        try:
+            fmt = select_format(probe, mode)
+        except TooLarge:
+            if mode != "video" or not COMPRESS_OVERSIZE or not compression_plan(probe.get("duration"), UPLOAD_LIMIT):
+                raise
+            # Fetch the best source we're willing to re-encode; it's compressed below
+            fmt = select_format(probe, mode, COMPRESS_SOURCE_MAX)
+            opts['max_filesize'] = COMPRESS_SOURCE_MAX
+        if fmt:
+            opts['format'] = fmt
+        job = download_engine.submit(user.id, url, opts, probe, reserved=True)
+        reserved = False
+        pos = download_engine.position(job)
+        status_msg = await status_msg.edit_text(
+            "📥 Downloading..." if pos == 0 else f"⏳ Queued (position {pos})...",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("✖️ Cancel", callback_data=f"cancel_dl:{job.id}")]])
+        )
+        info = await wait_for_download(job, status_msg)
+        if mode == "audio":
+            filename = info.get("filepath") or filename
+        if not os.path.exists(filename):
+            # yt-dlp skips (without an error) files over max_filesize
+            raise TooLarge()
+        if mode == "video" and os.path.getsize(filename) > UPLOAD_LIMIT:
+            if not COMPRESS_OVERSIZE:
+                raise TooLarge()
+            status_msg = await status_msg.edit_text("🗜️ Compressing to fit Telegram's size limit...")
+            compressed = await compress_to_size(filename, UPLOAD_LIMIT, info.get("duration") or probe.get("duration"))
+            os.replace(compressed, filename)
+        with open(filename, 'rb') as f, upload_seconds.time():
+            sent = await reply_media(update.message, mode, f, filename)
+        file_id = sent_file_id(sent)
+        if file_id:
+            id_key = video_id_key(info)
+            if id_key and mode == "audio":
+                id_key = "audio|" + id_key
+            media_cache.put([url_key, id_key], file_id)
+        if mode == "video":
+            file_registry[sent.message_id] = filename
+            track_media(filename, sent.message_id)
+        else:
+            os.remove(filename)
+        await status_msg.delete()
+        count_download(username, user_data)
+        resolve_flight(flight, file_id)
+    except DownloadCancelled as e:
+        # The cancel button already edited the status message
+        remove_partial_download(filename)
+        resolve_flight(flight, error=e)
+    except TooLarge as e:
+        remove_partial_download(filename)
+        resolve_flight(flight, error=e)
+        try:
+            await status_msg.edit_text(f"❌ This file is larger than {UPLOAD_LIMIT // (1024 * 1024)} MB and can't be sent.")
+        except:
+            pass
+    except Exception as e:
+        remove_partial_download(filename)
+        resolve_flight(flight, error=e)
+        handler_failed()
         logging.error(f"handle_video error: {e}")
+        try:
+            await status_msg.edit_text("❌ Download failed. Please check the link or try again later.")
+        except:
+            pass
+    finally:
+        if reserved:
+            download_engine.unreserve(user.id)
+        if inflight_videos.get(url_key) is flight:
+            del inflight_videos[url_key]
+        if not flight.done():
+            resolve_flight(flight, error=DownloadCancelled())
 
 
 # --- [INLINE HANDLER] ---
+async def ensure_media(bot, path, owner):
+    """True if `path` is usable, re-fetching cache-served videos and extending retention."""
+    if os.path.exists(path) or await fetch_remote_file(bot, path, owner):
+        janitor.touch(path)
+        return True
+    return False
+
+@instrumented
 async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    username = query.from_user.username
+    username = query.from_user.username or f"user_{query.from_user.id}"
 
     # Ban check
     if username and users.get(username, {}).get("banned"):
@@ -291,13 +2313,18 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # === NEW: Handle Text-to-PDF button callback ===
     if data == "text_pdf":
         await query.message.reply_text(
-            "📄 Send me the text you want converted to PDF.\n"
+            "📄 Send me the text (or a .txt file) you want converted to PDF.\n"
             "(You have 1 free trial; premium users have no limit.)"
         )
         # Mark that next text from this user is for conversion
         context.user_data["awaiting_text_pdf"] = True
         return
 
+    if data == "audio_only":
+        await query.message.reply_text("🎵 Send me the link you want as audio only.")
+        context.user_data["awaiting_audio"] = True
+        return
+
     # === NEW: Handle Admin Broadcast button callback ===
     if data == "admin_broadcast":
         if query.from_user.id == ADMIN_ID:
@@ -307,6 +2334,11 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.answer("⛔ You are not authorized.", show_alert=True)
         return
 
+    if data.startswith("cancel_dl:"):
+        if download_engine.cancel(data.split(":", 1)[1], query.from_user.id):
+            await query.edit_message_text("✖️ Download cancelled.")
+        return
+
     # === Existing upgrade / invoice logic ===
     if data == "upgrade_plan":
         opts = [
@@ -317,14 +2349,17 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if data.startswith("invoice_"):
         amount = float(data.split("_")[1])
-        invoice = await create_invoice(username, amount)
+        try:
+            invoice = await create_invoice(username, amount)
+        except Exception as e:
+            logging.error(f"create_invoice error: {e}")
+            return await query.message.reply_text("❌ Payment service is unavailable. Please try again later.")
         return await query.message.reply_text(f"Please pay ${amount} here:\n{invoice.get('invoice_url')}")
 
     if data == "profile":
-        downgrade_expired_users()
         user_data = users.get(username, {"plan": "free"})
-        if is_premium(user_data):
-            exp_dt = datetime.fromisoformat(user_data["expires"])
+        if is_premium(user_data, username):
+            exp_dt = expiry_index[username]
             msg = f"👤 Username: @{username}\n💼 Plan: Premium\n⏰ Expires: {exp_dt.strftime('%Y-%m-%d %H:%M')} UTC"
         else:
             msg = f"👤 Username: @{username}\n💼 Plan: Free"
@@ -337,8 +2372,9 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if data.startswith("audio:"):
+        release_lane()
         file = data.split("audio:")[1]
-        if not os.path.exists(file):
+        if not await ensure_media(context.bot, file, query.from_user.id):
             await query.message.reply_text("❌ File deleted. Please resend the link.")
         else:
             await convert_to_audio(update, context, file)
@@ -346,48 +2382,280 @@ async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # === NEW: Handle GIF conversion callback ===
     if data.startswith("gif:"):
+        release_lane()
         video_path = data.split("gif:")[1]
+        if not await ensure_media(context.bot, video_path, query.from_user.id):
+            return await query.message.reply_text("❌ File deleted. Please resend the link.")
         # Pass to the video-to-GIF handler
         fake_msg = type("msg", (), {"message": query.message, "effective_user": query.from_user, "video": type("v", (), {"file_id": None})})
         # We’ll embed conversion logic directly here instead of separate function
         user_id = query.from_user.id
-        username = query.from_user.username
+        username = query.from_user.username or f"user_{user_id}"
         user = users.get(username, {"plan": "free", "video_gif_trial": False})
-        if not is_premium(user) and user.get("video_gif_trial"):
+        if not is_premium(user, username) and user.get("video_gif_trial"):
             return await query.message.reply_text("⛔ Free trial used. Upgrade to use again.")
         # Mark trial if not premium
-        if not is_premium(user):
+        if not is_premium(user, username):
             users[username]["video_gif_trial"] = True
-            save_users(users)
+            save_user(username)
 
         # Convert the video file at video_path to GIF
         try:
-            input_path = video_path
-            output_path = f"/mnt/data/{username}_converted.gif"
-            # Limit to first 10 seconds
-            clip = ffmpeg.input(input_path, ss=0, t=10)
-            clip = clip.filter('fps', fps=10)
-            clip = clip.filter('scale', 320, -1)  # optional sizing
-            clip = ffmpeg.output(clip, output_path)
-            clip.run(overwrite_output=True)
-            await query.message.reply_document(document=open(output_path, "rb"), filename="converted.gif")
-            os.remove(output_path)
-        except Exception:
+            await send_conversion(query.message, video_path, "gif", "converted.gif")
+        except Exception as e:
+            handler_failed()
+            logging.error(f"GIF conversion error: {e}")
             await query.message.reply_text("❌ Failed to convert video to GIF.")
         return
 
     # Fall-back: do nothing for unrecognized callback_data
 
 
+# --- [PDF BUILDER] ---
+# Telegram photos are baseline/progressive JPEGs, which PDF can embed as-is
+# (DCTDecode). Pages are written one at a time, so memory stays at roughly
+# one image regardless of page count. Only images larger than PDF_MAX_DIM
+# (or non-JPEG input) are decoded, in a process pool.
+PDF_MAX_DIM = int(os.getenv("PDF_MAX_DIM", 0))        # 0 = never downscale
+PDF_JPEG_QUALITY = 85
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+JPEG_COLOR_SPACES = {1: b"/DeviceGray", 3: b"/DeviceRGB", 4: b"/DeviceCMYK /Decode [1 0 1 0 1 0 1 0]"}
+
+# Created on first use. The process is multi-threaded by then, so workers
+# come from a forkserver (spawn off Linux) rather than a bare fork; they
+# import this module once, which is inert outside __main__.
+image_pool = None
+image_pool_lock = threading.Lock()
+
+def get_image_pool():
+    global image_pool
+    with image_pool_lock:
+        if image_pool is None:
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            image_pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1,
+                                             mp_context=multiprocessing.get_context(method))
+        return image_pool
+
+def jpeg_info(data):
+    """Return (width, height, components) from a JPEG's SOF header, or None."""
+    if data[:2] != b"\xff\xd8":
+        return None
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:                      # fill byte
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+            i += 2
+            continue
+        if marker in JPEG_SOF_MARKERS:
+            height = int.from_bytes(data[i + 5:i + 7], "big")
+            width = int.from_bytes(data[i + 7:i + 9], "big")
+            return width, height, data[i + 9]
+        i += 2 + int.from_bytes(data[i + 2:i + 4], "big")
+    return None
+
+def _reencode_jpeg(data, max_dim, quality):
+    # Runs in image_pool; PIL is only needed on this slow path
+    import io
+    from PIL import Image
+    img = Image.open(io.BytesIO(data)).convert("RGB")
+    if max_dim:
+        img.thumbnail((max_dim, max_dim))
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=quality)
+    return out.getvalue()
+
+class StreamingPdf:
+    """Minimal PDF writer that appends pages to the binary file object `out`."""
+    def __init__(self, out):
+        self.out = out
+        self.offsets = {}
+        self.next_id = 3            # 1 = catalog, 2 = page tree (written on close)
+        self.pages = []
+        self.out.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def new_id(self):
+        self.next_id += 1
+        return self.next_id - 1
+
+    def write_obj(self, obj_id, body, stream=None):
+        self.offsets[obj_id] = self.out.tell()
+        self.out.write(b"%d 0 obj\n" % obj_id + body)
+        if stream is not None:
+            self.out.write(b"\nstream\n")
+            self.out.write(stream)
+            self.out.write(b"\nendstream")
+        self.out.write(b"\nendobj\n")
+
+    def add_page(self, width, height, resources, content, compress=False):
+        content_id, page_id = self.new_id(), self.new_id()
+        if compress:
+            content = zlib.compress(content, 6)
+            self.write_obj(content_id, b"<< /Length %d /Filter /FlateDecode >>" % len(content), content)
+        else:
+            self.write_obj(content_id, b"<< /Length %d >>" % len(content), content)
+        self.write_obj(page_id, b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %s %s] /Resources %s /Contents %d 0 R >>"
+                       % (pdf_num(width), pdf_num(height), resources, content_id))
+        self.pages.append(page_id)
+
+    def add_jpeg(self, data, width, height, components):
+        image_id = self.new_id()
+        self.write_obj(image_id, b"<< /Type /XObject /Subtype /Image /Width %d /Height %d "
+                                 b"/ColorSpace %s /BitsPerComponent 8 /Filter /DCTDecode /Length %d >>"
+                       % (width, height, JPEG_COLOR_SPACES[components], len(data)), data)
+        self.add_page(width, height, b"<< /XObject << /Im0 %d 0 R >> >>" % image_id,
+                      b"q %d 0 0 %d 0 0 cm /Im0 Do Q" % (width, height))
+
+    def close(self):
+        kids = b" ".join(b"%d 0 R" % p for p in self.pages)
+        self.write_obj(2, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self.pages)))
+        self.write_obj(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+        xref = self.out.tell()
+        self.out.write(b"xref\n0 %d\n0000000000 65535 f \n" % self.next_id)
+        for obj_id in range(1, self.next_id):
+            self.out.write(b"%010d 00000 n \n" % self.offsets[obj_id])
+        self.out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (self.next_id, xref))
+
+def pdf_num(value):
+    return (b"%.2f" % value).rstrip(b"0").rstrip(b".")
+
+def _read_source(src):
+    if isinstance(src, (bytes, bytearray)):
+        return bytes(src)
+    with open(src, "rb") as f:
+        return f.read()
+
+def _page_job(data):
+    # None if the JPEG can be embedded untouched, else a future for the re-encode
+    info = jpeg_info(data)
+    if info and info[2] in JPEG_COLOR_SPACES and not (PDF_MAX_DIM and max(info[:2]) > PDF_MAX_DIM):
+        return None
+    return get_image_pool().submit(_reencode_jpeg, data, PDF_MAX_DIM, PDF_JPEG_QUALITY)
+
+def write_image_pdf(sources, out_path):
+    """Write `sources` (paths or JPEG bytes) to `out_path`, one page each.
+
+    Blocking; run it in an executor. Re-encodes are kept at most a CPU count
+    ahead of the writer so they overlap without piling up in memory.
+    """
+    window = max(1, os.cpu_count() or 1)
+    queued = collections.deque()
+    sources = iter(sources)
+    with open(out_path, "wb") as f:
+        pdf = StreamingPdf(f)
+        while True:
+            while len(queued) < window:
+                src = next(sources, None)
+                if src is None:
+                    break
+                data = _read_source(src)
+                queued.append((data, _page_job(data)))
+            if not queued:
+                break
+            data, job = queued.popleft()
+            if job is not None:
+                data = job.result()
+            width, height, components = jpeg_info(data)
+            pdf.add_jpeg(data, width, height, components)
+        pdf.close()
+
+
+# --- [TEXT PDF RENDERER] ---
+# Helvetica (a PDF base font, so nothing is embedded) with WinAnsi encoding.
+# Lines are broken on measured width using the standard AFM advance widths;
+# word widths are memoized since natural text repeats words constantly.
+TEXT_PDF_FONT_SIZE = 12
+TEXT_PDF_LEADING   = 14.4
+TEXT_PDF_MARGIN    = 28.35                 # 10 mm
+TEXT_PDF_PAGE      = (595.28, 841.89)      # A4 in points
+TEXT_PDF_MAX_BYTES = int(os.getenv("TEXT_PDF_MAX_BYTES", 2 * 1024 * 1024))
+
+HELVETICA_WIDTHS = [556] * 256             # cp1252 code -> width in 1/1000 em
+HELVETICA_WIDTHS[32:127] = [
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584
+]
+HELVETICA_WIDTHS[0xA0] = 278
+
+@functools.lru_cache(maxsize=65536)
+def word_width(word):
+    return sum(map(HELVETICA_WIDTHS.__getitem__, word))
+
+def wrap_paragraph(data, max_units):
+    """Greedy word wrap of one cp1252 paragraph; overlong words are split."""
+    space = HELVETICA_WIDTHS[32]
+    lines, line, width = [], [], 0
+    for word in data.split(b" "):
+        w = word_width(word)
+        if w > max_units:
+            if line:
+                lines.append(b" ".join(line))
+                line, width = [], 0
+            chunk, chunk_w = bytearray(), 0
+            for ch in word:
+                if chunk_w + HELVETICA_WIDTHS[ch] > max_units and chunk:
+                    lines.append(bytes(chunk))
+                    chunk, chunk_w = bytearray(), 0
+                chunk.append(ch)
+                chunk_w += HELVETICA_WIDTHS[ch]
+            word, w = bytes(chunk), chunk_w
+        added = w + space if line else w
+        if line and width + added > max_units:
+            lines.append(b" ".join(line))
+            line, width = [word], w
+        else:
+            line.append(word)
+            width += added
+    lines.append(b" ".join(line))
+    return lines
+
+def render_text_pdf(text):
+    """Render plain text to PDF bytes (CPU-bound; run it in an executor)."""
+    page_w, page_h = TEXT_PDF_PAGE
+    max_units = (page_w - 2 * TEXT_PDF_MARGIN) * 1000 / TEXT_PDF_FONT_SIZE
+    lines_per_page = int((page_h - 2 * TEXT_PDF_MARGIN) // TEXT_PDF_LEADING)
+    out = io.BytesIO()
+    pdf = StreamingPdf(out)
+    font_id = pdf.new_id()
+    pdf.write_obj(font_id, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>")
+    resources = b"<< /Font << /F1 %d 0 R >> >>" % font_id
+    header = b"BT /F1 %d Tf %s TL %s %s Td\n" % (
+        TEXT_PDF_FONT_SIZE, pdf_num(TEXT_PDF_LEADING), pdf_num(TEXT_PDF_MARGIN),
+        pdf_num(page_h - TEXT_PDF_MARGIN - TEXT_PDF_FONT_SIZE))
+
+    page = []
+    for paragraph in re.split(r'\r?\n|\u2028|\u2029', text.strip()):
+        data = paragraph.replace("\t", "    ").encode("cp1252", errors="replace")
+        for line in wrap_paragraph(data, max_units):
+            line = line.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)")
+            page.append(b"(" + line + b") Tj T*")
+            if len(page) == lines_per_page:
+                pdf.add_page(page_w, page_h, resources, header + b"\n".join(page) + b"\nET", compress=True)
+                page = []
+    if page or not pdf.pages:
+        pdf.add_page(page_w, page_h, resources, header + b"\n".join(page) + b"\nET", compress=True)
+    pdf.close()
+    return out.getvalue()
+
+
 # --- [PDF FROM IMAGES HANDLER] ---
+@instrumented
 async def convert_pdf(update: Update, context: ContextTypes.DEFAULT_TYPE, triggered_by_button=False):
     user_id = update.effective_user.id
-    username = update.effective_user.username
+    username = update.effective_user.username or f"user_{user_id}"
     if username and users.get(username, {}).get("banned"):
         return await update.message.reply_text("⛔ You are banned from using this bot.")
 
     user_data = users.get(username, {"plan": "free"})
-    if not is_premium(user_data):
+    if not is_premium(user_data, username):
         if pdf_trials.get(user_id, 0) >= 1:
             return await update.message.reply_text("⛔ Free users can only convert 1 PDF.")
         pdf_trials[user_id] = 1
@@ -395,202 +2663,103 @@ async def convert_pdf(update: Update, context: ContextTypes.DEFAULT_TYPE, trigge
     images = image_collections.get(user_id, [])
     if not images:
         return await update.message.reply_text("❌ No images received.")
+    release_lane()
     try:
-        pil_images = [Image.open(img).convert("RGB") for img in images]
         pdf_path = generate_filename("pdf")
-        pil_images[0].save(pdf_path, save_all=True, append_images=pil_images[1:])
+        await asyncio.get_running_loop().run_in_executor(None, write_image_pdf, images, pdf_path)
         with open(pdf_path, 'rb') as f:
             await update.message.reply_document(f, filename="converted.pdf")
-        # Schedule PDF deletion correctly (no extra create_task call)
-        delete_file_later(pdf_path)
+        janitor.track(pdf_path, retention=60)
+        record_daily("conversions")
 
-        # Remove each source image from disk
-        for img in images:
-            os.remove(img)
         # Clear this user's in-memory image list
-        image_collections[user_id] = []
-    except:
+        image_collections.pop(user_id)
+    except Exception as e:
+        handler_failed()
+        logging.error(f"convert_pdf error: {e}")
         await update.message.reply_text("❌ Failed to generate PDF.")
 
 
 # --- [IMAGE HANDLER] ---
+# Photos are kept in memory (bytes) until /convertpdf. Albums arrive as one
+# update per photo sharing a media_group_id; they are collected until the
+# group goes quiet for ALBUM_WAIT seconds, downloaded concurrently and
+# acknowledged once.
+ALBUM_WAIT = 1.0
+PHOTO_DOWNLOAD_CONCURRENCY = int(os.getenv("PHOTO_DOWNLOAD_CONCURRENCY", 8))
+PDF_MAX_IMAGES = int(os.getenv("PDF_MAX_IMAGES", 50))
+
+photo_download_slots = asyncio.Semaphore(PHOTO_DOWNLOAD_CONCURRENCY)
+pending_albums = {}   # (user id, media_group_id) -> {"photos": [(message id, file id)], "task": Task}
+
+async def download_photo(bot, file_id):
+    async with photo_download_slots:
+        tg_file = await bot.get_file(file_id)
+        return bytes(await tg_file.download_as_bytearray())
+
+async def ingest_photos(update: Update, context: ContextTypes.DEFAULT_TYPE, photos):
+    user_id = update.effective_user.id
+    room = max(PDF_MAX_IMAGES - len(image_collections.get(user_id, [])), 0)
+    accepted = sorted(photos)[:room]
+    results = await asyncio.gather(
+        *[download_photo(context.bot, file_id) for _, file_id in accepted], return_exceptions=True
+    )
+    images = [r for r in results if isinstance(r, bytes)]
+    for r in results:
+        if not isinstance(r, bytes):
+            logging.error(f"Photo download failed: {r}")
+    image_collections.setdefault(user_id, []).extend(images)
+    image_collections.trim()
+
+    if len(photos) == 1 and images:
+        text = "✅ Image received."
+    else:
+        text = f"✅ {len(images)} images received."
+    text += " Send more or click /convertpdf to generate PDF."
+    if len(accepted) < len(photos):
+        text += f"\n⚠️ A PDF can hold up to {PDF_MAX_IMAGES} images; the rest were skipped."
+    if len(images) < len(accepted):
+        text += f"\n⚠️ {len(accepted) - len(images)} image(s) failed to download."
+    await update.message.reply_text(text)
+
+async def _flush_album(key, update, context):
+    await asyncio.sleep(ALBUM_WAIT)
+    batch = pending_albums.pop(key)
+    await ingest_photos(update, context, batch["photos"])
+
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    username = update.effective_user.username
+    username = update.effective_user.username or f"user_{user_id}"
     if username and users.get(username, {}).get("banned"):
         return await update.message.reply_text("⛔ You are banned from using this bot.")
 
-    photo = update.message.photo[-1]
-    file = await context.bot.get_file(photo.file_id)
-    image_path = f"image_{datetime.utcnow().strftime('%H%M%S%f')}.jpg"
-    await file.download_to_drive(image_path)
-    image_collections.setdefault(user_id, []).append(image_path)
-    await update.message.reply_text("✅ Image received. Send more or click /convertpdf to generate PDF.")
-
-
-# --- [ADMIN COMMANDS] ---
-async def upgrade(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != ADMIN_ID:
-        return
-    args = context.args
-    if len(args) != 2:
-        return await update.message.reply_text("Usage: /upgrade <username> <hours>")
-    username, hours = args
-    username = username.lstrip('@')
-    if username not in users:
-        return await update.message.reply_text("❌ User not found.")
-    try:
-        hours = int(hours)
-        expires = datetime.utcnow() + timedelta(hours=hours)
-        users[username]["plan"] = "premium"
-        users[username]["expires"] = expires.isoformat()
-        save_users(users)
-        return await update.message.reply_text(f"✅ Upgraded @{username} until {expires.strftime('%Y-%m-%d %H:%M')} UTC")
-    except:
-        return await update.message.reply_text("❌ Invalid hours")
-
-async def downgrade(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != ADMIN_ID:
-        return
-    args = context.args
-    if not args:
-        return await update.message.reply_text("Usage: /downgrade <username>")
-    username = args[0].lstrip('@')
-    if username in users:
-        users[username] = {"plan": "free", "downloads": 0, "banned": users[username].get("banned", False),
-                           "text_pdf_trial": users[username].get("text_pdf_trial", False),
-                           "video_gif_trial": users[username].get("video_gif_trial", False)}
-        save_users(users)
-        return await update.message.reply_text(f"✅ Downgraded @{username} to free plan.")
+    photo = (update.message.message_id, update.message.photo[-1].file_id)
+    group = update.message.media_group_id
+    if not group:
+        return await ingest_photos(update, context, [photo])
 
-async def ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != ADMIN_ID:
-        return
-    if len(context.args) != 1:
-        return await update.message.reply_text("Usage: /ban <username>")
-    username = context.args[0].lstrip('@')
-    if username in users:
-        users[username]["banned"] = True
-        save_users(users)
-        return await update.message.reply_text(f"⛔ Banned @{username}")
-    return await update.message.reply_text("❌ User not found.")
-
-async def unban(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != ADMIN_ID:
-        return
-    if len(context.args) != 1:
-        return await update.message.reply_text("Usage: /unban <username>")
-    username = context.args[0].lstrip('@')
-    if username in users and users[username].get("banned"):
-        users[username]["banned"] = False
-        save_users(users)
-        return await update.message.reply_text(f"✅ Unbanned @{username}")
-    return await update.message.reply_text("❌ User not found or not banned.")
-
-async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != ADMIN_ID:
-        return
-    downgrade_expired_users()
-    total = len(users)
-    premium = sum(1 for u in users.values() if u.get("plan") == "premium")
-    free = total - premium
-    downloads = sum(u.get("downloads", 0) for u in users.values())
-    await update.message.reply_text(
-        f"📊 Stats:\n"
-        f"Total Users: {total}\n"
-        f"Premium: {premium}\n"
-        f"Free: {free}\n"
-        f"Total Downloads: {downloads}"
-    )
-
-async def export(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != ADMIN_ID:
-        return
-    path = "/mnt/data/export.csv"
-    with open(path, "w", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow(["Username", "Plan", "Expires", "Banned", "TextPDF_Used", "VideoGIF_Used"])
-        for uname, data in users.items():
-            writer.writerow([
-                uname,
-                data.get("plan", "free"),
-                data.get("expires", "N/A"),
-                data.get("banned", False),
-                data.get("text_pdf_trial", False),
-                data.get("video_gif_trial", False)
-            ])
-    with open(path, "rb") as f:
-        await update.message.reply_document(f, filename="users.csv")
-
-
-# --- [SUPPORT SYSTEM] ---
-async def support_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.reply_to_message and update.effective_user.id == ADMIN_ID:
-        msg_id = update.message.reply_to_message.message_id
-        if msg_id in support_messages:
-            uid = support_messages[msg_id]
-            await context.bot.send_message(chat_id=uid, text=f"📬 Admin reply:\n{update.message.text}")
-
-async def user_support(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id == ADMIN_ID:
-        return
-    forwarded = await context.bot.send_message(
-        ADMIN_ID,
-        f"📩 Message from @{update.effective_user.username}:\n\n{update.message.text}"
-    )
-    support_messages[forwarded.message_id] = update.effective_user.id
-    await update.message.reply_text("✅ Message sent. You’ll get a reply soon.")
+    # Restart the quiet-period timer on every photo of the album
+    key = (user_id, group)
+    batch = pending_albums.setdefault(key, {"photos": [], "task": None})
+    batch["photos"].append(photo)
+    if batch["task"]:
+        batch["task"].cancel()
+    batch["task"] = asyncio.create_task(_flush_album(key, update, context))
 
 
 # --- [TEXT MESSAGE HANDLER] ---
+@instrumented
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if context.user_data.get("awaiting_broadcast"):
         if update.effective_user.id == ADMIN_ID:
             context.user_data["awaiting_broadcast"] = False
-            message_text = update.message.text
-            count = 0
-            for uname, data in users.items():
-                if data.get("banned"):
-                    continue
-                chat_id = data.get("user_id")
-                if chat_id:
-                    try:
-                        await context.bot.send_message(chat_id=chat_id, text=message_text)
-                        count += 1
-                        await asyncio.sleep(0.05)
-                    except:
-                        pass
-            return await update.message.reply_text(f"✅ Broadcast sent to {count} users.")
+            status = await update.message.reply_text("📣 Broadcast queued...")
+            job = await start_broadcast(context.bot, update.message.text, status.chat_id, status.message_id)
+            return await report_broadcast(context.bot, job)
 
     if context.user_data.get("awaiting_text_pdf"):
         context.user_data["awaiting_text_pdf"] = False
-        user = update.effective_user
-        username = user.username or f"user_{user.id}"
-        user_data = users.get(username, {"plan": "free"})
-
-        if not is_premium(user_data):
-            if user_data.get("text_pdf_trial"):
-                return await update.message.reply_text("⛔ Free trial used. Upgrade your plan to use again.")
-            users[username]["text_pdf_trial"] = True
-            save_users(users)
-
-        text = update.message.text
-        pdf = FPDF()
-        pdf.set_auto_page_break(auto=True, margin=15)
-        pdf.add_page()
-        pdf.set_font("Arial", size=12)
-
-        max_width = 90
-        for paragraph in re.split(r'\r?\n|\u2028|\u2029', text.strip()):
-            lines = [paragraph[i:i+max_width] for i in range(0, len(paragraph), max_width)]
-            for line in lines:
-                pdf.multi_cell(0, 10, line)
-
-        file_path = f"/mnt/data/{username}_text.pdf"
-        pdf.output(file_path)
-        await update.message.reply_document(document=open(file_path, "rb"), filename="converted_text.pdf")
-        os.remove(file_path)
-        return
+        return await send_text_pdf(update, update.message.text)
 
     if update.effective_user.id != ADMIN_ID and not update.message.text.startswith("/"):
         forwarded = await context.bot.send_message(
@@ -601,13 +2770,45 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await update.message.reply_text("✅ Message sent. You’ll get a reply soon.")
 
 
+async def send_text_pdf(update: Update, text):
+    user = update.effective_user
+    username = user.username or f"user_{user.id}"
+    user_data = users.get(username, {"plan": "free"})
+
+    if not is_premium(user_data, username):
+        if user_data.get("text_pdf_trial"):
+            return await update.message.reply_text("⛔ Free trial used. Upgrade your plan to use again.")
+        users[username]["text_pdf_trial"] = True
+        save_user(username)
+
+    release_lane()
+    pdf_bytes = await asyncio.get_running_loop().run_in_executor(None, render_text_pdf, text)
+    await update.message.reply_document(document=pdf_bytes, filename="converted_text.pdf")
+    record_daily("conversions")
+
+async def handle_text_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # A .txt file sent while Text-to-PDF is waiting for input
+    if not context.user_data.get("awaiting_text_pdf"):
+        return
+    context.user_data["awaiting_text_pdf"] = False
+    doc = update.message.document
+    if doc.file_size and doc.file_size > TEXT_PDF_MAX_BYTES:
+        return await update.message.reply_text(
+            f"❌ Text files are limited to {TEXT_PDF_MAX_BYTES // (1024 * 1024)} MB."
+        )
+    tg_file = await context.bot.get_file(doc.file_id)
+    raw = bytes(await tg_file.download_as_bytearray())
+    await send_text_pdf(update, raw.decode("utf-8-sig", errors="replace"))
+
+
 # --- [VIDEO TO GIF HELPER] ---
 # (Already handled inline in handle_button under `gif:` callback_data)
 
 
 # --- [COMMAND HANDLERS] ---
+STATS_DAYS = 7
+
 async def upgrade(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # unchanged from original
     if update.effective_user.id != ADMIN_ID:
         return
     args = context.args
@@ -622,13 +2823,13 @@ async def upgrade(update: Update, context: ContextTypes.DEFAULT_TYPE):
         expires = datetime.utcnow() + timedelta(hours=hours)
         users[username]["plan"] = "premium"
         users[username]["expires"] = expires.isoformat()
-        save_users(users)
+        index_expiry(username)
+        save_user(username)
         return await update.message.reply_text(f"✅ Upgraded @{username} until {expires.strftime('%Y-%m-%d %H:%M')} UTC")
     except:
         return await update.message.reply_text("❌ Invalid hours")
 
 async def downgrade(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # unchanged from original
     if update.effective_user.id != ADMIN_ID:
         return
     args = context.args
@@ -639,11 +2840,11 @@ async def downgrade(update: Update, context: ContextTypes.DEFAULT_TYPE):
         users[username] = {"plan": "free", "downloads": 0, "banned": users[username].get("banned", False),
                            "text_pdf_trial": users[username].get("text_pdf_trial", False),
                            "video_gif_trial": users[username].get("video_gif_trial", False)}
-        save_users(users)
+        index_expiry(username)
+        save_user(username)
         return await update.message.reply_text(f"✅ Downgraded @{username} to free plan.")
 
 async def ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # unchanged from original
     if update.effective_user.id != ADMIN_ID:
         return
     if len(context.args) != 1:
@@ -651,12 +2852,11 @@ async def ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = context.args[0].lstrip('@')
     if username in users:
         users[username]["banned"] = True
-        save_users(users)
+        save_user(username)
         return await update.message.reply_text(f"⛔ Banned @{username}")
     return await update.message.reply_text("❌ User not found.")
 
 async def unban(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # unchanged from original
     if update.effective_user.id != ADMIN_ID:
         return
     if len(context.args) != 1:
@@ -664,46 +2864,127 @@ async def unban(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = context.args[0].lstrip('@')
     if username in users and users[username].get("banned"):
         users[username]["banned"] = False
-        save_users(users)
+        save_user(username)
         return await update.message.reply_text(f"✅ Unbanned @{username}")
     return await update.message.reply_text("❌ User not found or not banned.")
 
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # unchanged from original
     if update.effective_user.id != ADMIN_ID:
         return
-    downgrade_expired_users()
-    total = len(users)
-    premium = sum(1 for u in users.values() if u.get("plan") == "premium")
+    total = user_totals["users"]
+    premium = user_totals["premium"]
     free = total - premium
-    downloads = sum(u.get("downloads", 0) for u in users.values())
+    downloads = user_totals["downloads"]
+    # Queued behind the pending counter flush, so today's numbers are current
+    flush_daily()
+    series = await asyncio.get_running_loop().run_in_executor(db_executor, daily_series, STATS_DAYS)
+    days = [(datetime.utcnow() - timedelta(days=i)).strftime("%Y-%m-%d") for i in range(STATS_DAYS)]
+    daily = "\n".join(f"{day[5:]}: {series[day]['downloads']} downloads, {series[day]['conversions']} conversions"
+                      for day in days)
     await update.message.reply_text(
         f"📊 Stats:\n"
         f"Total Users: {total}\n"
         f"Premium: {premium}\n"
         f"Free: {free}\n"
-        f"Total Downloads: {downloads}"
+        f"Total Downloads: {downloads}\n"
+        f"Video cache: {media_cache.hits} hits / {media_cache.misses} misses "
+        f"({media_cache.hit_rate():.0%})\n"
+        f"Conversion cache: {conversion_cache.hits} hits / {conversion_cache.misses} misses "
+        f"({conversion_cache.hit_rate():.0%})\n\n"
+        f"Last {STATS_DAYS} days:\n{daily}"
+    )
+
+def process_rss():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+async def memory(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Approximate footprint of the in-memory state maps
+    if update.effective_user.id != ADMIN_ID:
+        return
+    lines = []
+    for m in state_maps:
+        ttl = f"{m.ttl}s" if m.ttl else "none"
+        lines.append(f"{m.name}: {len(m)}/{m.max_entries} entries, ~{m.memory() / 1024:.0f} KB, "
+                     f"ttl {ttl}, {m.evictions} evicted, {m.expirations} expired"
+                     + (", persisted" if m.persist else ""))
+    lines.append(f"users: {len(users)} entries, ~{approx_size(users) / 1024:.0f} KB")
+    rss = process_rss()
+    if rss:
+        lines.append(f"Process RSS: {rss / 2**20:.1f} MB")
+    await update.message.reply_text("🧠 Memory:\n" + "\n".join(lines))
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /profile [seconds]: sample all threads and send the folded stacks
+    if update.effective_user.id != ADMIN_ID:
+        return
+    try:
+        seconds = min(float(context.args[0]), PROFILE_MAX_SECONDS) if context.args else 30
+    except ValueError:
+        return await update.message.reply_text("Usage: /profile [seconds]")
+    if profile_running.is_set():
+        return await update.message.reply_text("⏳ A profile is already running.")
+    profile_running.set()
+    release_lane()
+    await update.message.reply_text(f"🔬 Profiling for {seconds:g}s...")
+    try:
+        folded = await asyncio.get_running_loop().run_in_executor(None, sample_stacks, seconds)
+    finally:
+        profile_running.clear()
+    stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+    await update.message.reply_document(
+        folded.encode() or b"(no samples)\n", filename=f"profile-{stamp}.folded",
+        caption=f"Folded stacks, {PROFILE_INTERVAL * 1000:g} ms interval. "
+                f"Loop stalls > {LOOP_BLOCK_THRESHOLD:g}s so far: {loop_watchdog.blocks}"
     )
 
+EXPORT_COLUMNS = ["Username", "Plan", "Expires", "Banned", "TextPDF_Used", "VideoGIF_Used"]
+EXPORT_BATCH   = 1000
+
+def export_csv_chunks(rows):
+    """Yield the export CSV as encoded chunks of EXPORT_BATCH rows."""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(EXPORT_COLUMNS)
+    for i, (uname, data) in enumerate(rows, 1):
+        writer.writerow([
+            uname,
+            data.get("plan", "free"),
+            data.get("expires", "N/A"),
+            data.get("banned", False),
+            data.get("text_pdf_trial", False),
+            data.get("video_gif_trial", False)
+        ])
+        if i % EXPORT_BATCH == 0:
+            yield buf.getvalue().encode()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue().encode()
+
+def build_export(rows, compress=False):
+    out = io.BytesIO()
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None   # wbits 31 = gzip container
+    for chunk in export_csv_chunks(rows):
+        out.write(gz.compress(chunk) if gz else chunk)
+    if gz:
+        out.write(gz.flush())
+    out.seek(0)
+    return out
+
 async def export(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # unchanged from original except CSV now includes trials
+    # /export [gz]: users as CSV, built in memory off the event loop
     if update.effective_user.id != ADMIN_ID:
         return
-    path = "/mnt/data/export.csv"
-    with open(path, "w", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow(["Username", "Plan", "Expires", "Banned", "TextPDF_Used", "VideoGIF_Used"])
-        for uname, data in users.items():
-            writer.writerow([
-                uname,
-                data.get("plan", "free"),
-                data.get("expires", "N/A"),
-                data.get("banned", False),
-                data.get("text_pdf_trial", False),
-                data.get("video_gif_trial", False)
-            ])
-    with open(path, "rb") as f:
-        await update.message.reply_document(f, filename="users.csv")
+    compress = bool(context.args) and context.args[0].lower() in ("gz", "gzip")
+    rows = [(uname, dict(data)) for uname, data in users.items()]
+    document = await asyncio.get_running_loop().run_in_executor(None, build_export, rows, compress)
+    await update.message.reply_document(document, filename="users.csv.gz" if compress else "users.csv")
 
 
 # --- [SUPPORT SYSTEM] ---
@@ -726,34 +3007,350 @@ async def user_support(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # --- [WEBHOOK SETUP] ---
+current_lane = contextvars.ContextVar("current_lane", default=None)
+
+def release_lane():
+    """Let the rest of the current update run off its chat's lane.
+
+    Handlers call this before long waits (downloads, conversions,
+    profiling): the dispatcher worker moves on and the chat's next update
+    may start, while this handler keeps running as a detached task.
+    """
+    released = current_lane.get()
+    if released is not None:
+        released.set()
+
+class KeyedDispatcher:
+    """Process items on `workers` tasks; items sharing a key run one at a time, in order.
+
+    Each active key owns a lane (deque) and sits in `ready` at most once, so
+    a worker never picks up a key another worker is still processing.
+    submit() refuses new work once `max_pending` items are waiting. A
+    handler that calls release_lane() frees its worker and lane early, so
+    workers bound the updates being started, not how long handlers run.
+    """
+    def __init__(self, handler, workers, max_pending):
+        self.handler = handler
+        self.workers = workers
+        self.max_pending = max_pending
+        self.lanes = {}                 # key -> deque of items not yet started
+        self.ready = asyncio.Queue()    # keys with work and no worker on them
+        self.pending = 0
+        self.tasks = []
+        self.detached = set()           # handlers still running after release_lane()
+
+    def submit(self, key, item):
+        if self.pending >= self.max_pending:
+            return False
+        self.pending += 1
+        lane = self.lanes.get(key)
+        if lane is None:
+            self.lanes[key] = collections.deque([item])
+            self.ready.put_nowait(key)
+        else:
+            lane.append(item)
+        return True
+
+    async def _run(self, item, released):
+        current_lane.set(released)
+        try:
+            await self.handler(item)
+        except Exception as e:
+            logging.error(f"Update processing error: {e}")
+
+    async def _worker(self):
+        while True:
+            key = await self.ready.get()
+            lane = self.lanes[key]
+            item = lane.popleft()
+            released = asyncio.Event()
+            task = asyncio.create_task(self._run(item, released))
+            waiter = asyncio.create_task(released.wait())
+            try:
+                await asyncio.wait({task, waiter}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                waiter.cancel()
+                if not task.done():
+                    self.detached.add(task)
+                    task.add_done_callback(self.detached.discard)
+                self.pending -= 1
+                if lane:
+                    self.ready.put_nowait(key)
+                else:
+                    del self.lanes[key]
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        tasks = self.tasks + list(self.detached)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+def dispatch_key(update):
+    # Cancel buttons must not queue behind the download they cancel
+    query = update.callback_query
+    if query and query.data and query.data.startswith("cancel_dl:"):
+        return ("cancel", update.update_id)
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return update.update_id
+
+update_dispatcher = KeyedDispatcher(application.process_update, UPDATE_WORKERS, WEBHOOK_QUEUE_MAX)
 web_app = web.Application()
 
 async def webhook_handler(request):
     try:
         data = await request.json()
         update = Update.de_json(data, application.bot)
-        await application.update_queue.put(update)
     except Exception as e:
         logging.error(f"Webhook error: {e}")
+        return web.Response(text="ok")
+    if not update_dispatcher.submit(dispatch_key(update), update):
+        # Saturated: a non-2xx makes Telegram redeliver the update later
+        return web.Response(text="busy", status=503, headers={"Retry-After": "1"})
     return web.Response(text="ok")
 
 web_app.router.add_post("/webhook", webhook_handler)
 web_app.router.add_post("/ipn", ipn_handler)
+web_app.router.add_get("/metrics", metrics_handler)
+
+gauge("bot_download_queue_depth", "Download jobs waiting for a worker", lambda: len(download_engine.pending))
+gauge("bot_downloads_running", "Download jobs in progress", lambda: download_engine.running)
+gauge("bot_ffmpeg_running", "ffmpeg processes in progress", lambda: ffmpeg_running)
+gauge("bot_update_queue_depth", "Webhook updates accepted but not finished", lambda: update_dispatcher.pending)
+gauge("bot_update_detached", "Handlers still running after releasing their chat lane",
+      lambda: len(update_dispatcher.detached))
+gauge("bot_update_active_chats", "Chats with queued or running updates", lambda: len(update_dispatcher.lanes))
+gauge("bot_inflight_links", "Links being downloaded with waiters attached", lambda: len(inflight_videos))
+gauge("bot_dirty_users", "Users waiting to be flushed to the store", lambda: len(dirty_users))
+gauge("bot_broadcasts_running", "Broadcasts in progress", lambda: len(broadcast_tasks))
+gauge("bot_pending_invoices", "Invoices awaiting payment", lambda: len(pending_invoices))
+gauge("bot_event_loop_blocks_total", "Times the loop watchdog saw the loop stalled",
+      lambda: loop_watchdog.blocks, "counter")
+gauge("bot_temp_files", "Files tracked by the janitor", lambda: len(janitor.files))
+gauge("bot_temp_bytes", "Disk used by files tracked by the janitor", lambda: janitor.used)
+gauge("bot_cache_hits_total", "File-id cache hits",
+      lambda: {'cache="media"': media_cache.hits, 'cache="conversion"': conversion_cache.hits}, "counter")
+gauge("bot_cache_misses_total", "File-id cache misses",
+      lambda: {'cache="media"': media_cache.misses, 'cache="conversion"': conversion_cache.misses}, "counter")
+gauge("bot_cache_hit_ratio", "File-id cache hit ratio since start",
+      lambda: {'cache="media"': media_cache.hit_rate(), 'cache="conversion"': conversion_cache.hit_rate()})
 
 async def on_startup(app):
+    background_tasks.append(asyncio.create_task(user_store_flusher()))
+    if WORKERS > 1:
+        background_tasks.append(asyncio.create_task(user_store_refresher()))
+    if IS_PRIMARY:
+        background_tasks.append(asyncio.create_task(expiry_scheduler()))
+        background_tasks.append(asyncio.create_task(broadcast_adopter(application.bot)))
+    background_tasks.append(asyncio.create_task(invoice_scheduler()))
+    background_tasks.append(asyncio.create_task(janitor.run()))
+    background_tasks.append(asyncio.create_task(state_sweeper()))
+    loop_watchdog.start()
+    # Everything that talks to Telegram runs after the port is bound;
+    # updates that arrive meanwhile wait in update_dispatcher.
+    global startup_task
+    startup_task = asyncio.create_task(finish_startup())
+
+startup_task = None
+
+STARTUP_ATTEMPTS = 6
+
+async def start_telegram():
+    # Safe to repeat after a partial failure
     await application.initialize()
-    await application.start()
-    await application.bot.set_webhook(f"{APP_URL}/webhook")
-    logging.info("✅ Webhook set.")
+    if not application.running:
+        await application.start()
+    if not update_dispatcher.tasks:
+        update_dispatcher.start()
+    boot_mark("telegram init")
+    if IS_PRIMARY:
+        await application.bot.set_webhook(f"{APP_URL}/webhook")
+        await resume_broadcasts(application.bot)
+        logging.info("✅ Webhook set.")
+        boot_mark("set webhook")
+
+async def finish_startup():
+    boot_mark("app startup")
+    for attempt in range(1, STARTUP_ATTEMPTS + 1):
+        try:
+            await start_telegram()
+            break
+        except Exception as e:
+            logging.error(f"Telegram startup failed (attempt {attempt}/{STARTUP_ATTEMPTS}): {e}")
+            if attempt == STARTUP_ATTEMPTS:
+                # Exit non-zero so the platform restarts the service, as a
+                # failed startup did before it moved off the bind path
+                logging.critical("Giving up on Telegram startup; exiting")
+                await flush_users()
+                os._exit(1)
+            await asyncio.sleep(min(2 ** attempt, 60))
+    await asyncio.get_running_loop().run_in_executor(probe_executor, warm_ydl_pool)
+    boot_mark("yt-dlp warm-up")
+    logging.info("Startup: " + ", ".join(f"{step} {secs * 1000:.0f} ms" for step, secs in boot_timings)
+                 + f" (total {time.perf_counter() - BOOT_STARTED:.2f}s)")
 
 async def on_cleanup(app):
-    await application.stop()
+    if startup_task and not startup_task.done():
+        startup_task.cancel()
+        await asyncio.gather(startup_task, return_exceptions=True)
+    # Cancelled broadcasts save their progress and resume on the next start
+    for task in list(broadcast_tasks.values()):
+        task.cancel()
+    await asyncio.gather(*broadcast_tasks.values(), return_exceptions=True)
+    await update_dispatcher.stop()
+    if application.running:
+        await application.stop()
     await application.shutdown()
+    for task in background_tasks:
+        task.cancel()
+    await nowpayments.close()
+    await flush_users()
+    flush_daily()
+    loop_watchdog.stop()
 
 web_app.on_startup.append(on_startup)
 web_app.on_cleanup.append(on_cleanup)
 
 
+# --- [WORKER FRONT] ---
+# With WORKERS > 1 the front process owns the public port and forwards each
+# /webhook update to one worker, chosen by a consistent hash of the user id,
+# so a user's updates (and in-memory state such as image_collections) stay
+# on one worker; /ipn goes to the paying user's worker. Workers are
+# restarted if they exit. State other workers need lives in SQLite: users
+# (refreshed through the user_changes feed) and the kv table.
+WORKER_RESTART_DELAY = 2
+
+class HashRing:
+    def __init__(self, nodes, replicas=64):
+        self.ring = sorted((self._hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas))
+        self.points = [point for point, _ in self.ring]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], "big")
+
+    def node(self, key):
+        return self.ring[bisect.bisect(self.points, self._hash(key)) % len(self.ring)][1]
+
+def update_shard_key(data):
+    # The sender's id for every update type that has one
+    for value in data.values():
+        if isinstance(value, dict):
+            sender = value.get("from") or value.get("user")
+            if sender:
+                return sender.get("id")
+            chat = value.get("chat")
+            if chat:
+                return chat.get("id")
+    return data.get("update_id")
+
+def merge_worker_metrics(texts):
+    """Combine each worker's /metrics output, labelling samples worker="<index>"."""
+    families = {}   # metric name -> [HELP/TYPE lines, samples], in first-seen order
+    for index, text in texts:
+        family = None
+        for line in text.splitlines():
+            if line.startswith("# "):
+                family = line.split()[2]
+                headers = families.setdefault(family, [[], []])[0]
+                if line not in headers:
+                    headers.append(line)
+            elif line and family:
+                name, brace, rest = line.partition("{")
+                if brace:
+                    line = f'{name}{{worker="{index}",{rest}'
+                else:
+                    name, _, value = line.partition(" ")
+                    line = f'{name}{{worker="{index}"}} {value}'
+                families[family][1].append(line)
+    return "\n".join(line for headers, samples in families.values() for line in headers + samples) + "\n"
+
+def run_front():
+    if STORE_BACKEND != "sqlite":
+        raise SystemExit("WORKERS > 1 requires STORE_BACKEND=sqlite")
+    ring = HashRing(range(WORKERS))
+    procs = {}
+    front = web.Application()
+
+    def spawn(index):
+        env = dict(os.environ, WORKER_INDEX=str(index), PORT=str(WORKER_BASE_PORT + index))
+        procs[index] = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+
+    async def supervise():
+        while True:
+            await asyncio.sleep(WORKER_RESTART_DELAY)
+            for index, proc in procs.items():
+                if proc.poll() is not None:
+                    logging.error(f"Worker {index} exited with {proc.returncode}; restarting")
+                    spawn(index)
+
+    async def forward(request, index):
+        body = await request.read()
+        url = f"http://127.0.0.1:{WORKER_BASE_PORT + index}{request.path}"
+        try:
+            async with front["session"].post(url, data=body, headers={"Content-Type": "application/json"}) as resp:
+                headers = {"Retry-After": resp.headers["Retry-After"]} if "Retry-After" in resp.headers else None
+                return web.Response(body=await resp.read(), status=resp.status, headers=headers)
+        except aiohttp.ClientError as e:
+            logging.error(f"Worker {index} unreachable: {e}")
+            return web.Response(text="busy", status=503, headers={"Retry-After": "1"})
+
+    async def front_webhook(request):
+        try:
+            key = update_shard_key(await request.json())
+        except Exception:
+            key = None
+        return await forward(request, ring.node(key))
+
+    async def front_ipn(request):
+        # Route to the worker that owns the paying user so its copy is the one updated
+        try:
+            key = str((await request.json()).get("order_id", "")).split(":")[0]
+            row = state_db.execute("SELECT data FROM users WHERE username = ?", (key,)).fetchone()
+            key = json.loads(row[0]).get("user_id", key) if row else key
+        except Exception:
+            key = None
+        return await forward(request, ring.node(key))
+
+    async def front_metrics(request):
+        async def scrape(index):
+            try:
+                async with front["session"].get(f"http://127.0.0.1:{WORKER_BASE_PORT + index}/metrics") as resp:
+                    return index, await resp.text()
+            except aiohttp.ClientError as e:
+                logging.error(f"Worker {index} metrics unavailable: {e}")
+                return index, ""
+        texts = await asyncio.gather(*[scrape(index) for index in range(WORKERS)])
+        return web.Response(text=merge_worker_metrics(texts), content_type="text/plain", charset="utf-8")
+
+    async def front_startup(app):
+        app["session"] = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0, keepalive_timeout=60))
+        for index in range(WORKERS):
+            spawn(index)
+        app["supervisor"] = asyncio.create_task(supervise())
+
+    async def front_cleanup(app):
+        app["supervisor"].cancel()
+        for proc in procs.values():
+            proc.terminate()
+        for proc in procs.values():
+            proc.wait()
+        await app["session"].close()
+
+    front.router.add_post("/webhook", front_webhook)
+    front.router.add_post("/ipn", front_ipn)
+    front.router.add_get("/metrics", front_metrics)
+    front.on_startup.append(front_startup)
+    front.on_cleanup.append(front_cleanup)
+    web.run_app(front, port=PORT)
+
+
 # --- [HANDLER REGISTRATION] ---
 application.add_handler(CommandHandler("start", start))
 application.add_handler(CommandHandler("upgrade", upgrade))
@@ -762,19 +3359,31 @@ application.add_handler(CommandHandler("ban", ban))
 application.add_handler(CommandHandler("unban", unban))
 application.add_handler(CommandHandler("stats", stats))
 application.add_handler(CommandHandler("export", export))
+application.add_handler(CommandHandler("profile", profile_command))
+application.add_handler(CommandHandler("memory", memory))
+# Audio-only download: /audio <link>
+application.add_handler(CommandHandler("audio", audio_command))
 # Convert PDF from images
 application.add_handler(CommandHandler("convertpdf", lambda u, c: convert_pdf(u, c, False)))
 # Handle inline buttons
 application.add_handler(CallbackQueryHandler(handle_button))
 # Handle photos
 application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+# Handle .txt documents for Text-to-PDF
+application.add_handler(MessageHandler(filters.Document.TXT, handle_text_document))
 # Handle support replies (admin replying to forwarded message)
 application.add_handler(MessageHandler(filters.TEXT & filters.REPLY, support_reply))
 # Handle broadcast & text-to-PDF & user support & video links
 application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.Regex(r'^https?://'), handle_text))
 # Handle video links
 application.add_handler(MessageHandler(filters.TEXT & filters.Regex(r'^https?://'), handle_video))
+boot_mark("module setup")
 
 
 if __name__ == "__main__":
-    web.run_app(web_app, port=PORT)
+    if WORKERS > 1 and WORKER_INDEX is None:
+        run_front()
+    elif WORKER_INDEX is not None:
+        web.run_app(web_app, host="127.0.0.1", port=PORT)
+    else:
+        web.run_app(web_app, port=PORT)
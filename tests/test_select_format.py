@@ -0,0 +1,86 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="test_data_"))
+
+from main import select_format, TooLarge  # noqa: E402
+
+MB = 1024 * 1024
+LIMIT = 50 * MB
+
+
+def fmt(format_id, size=None, vcodec="avc1", acodec="mp4a", height=None, **extra):
+    return dict(format_id=format_id, filesize=size, vcodec=vcodec, acodec=acodec, height=height, **extra)
+
+
+def video(format_id, size=None, height=None):
+    return fmt(format_id, size, acodec="none", height=height)
+
+
+def audio(format_id, size=None, abr=None):
+    return fmt(format_id, size, vcodec="none", abr=abr)
+
+
+def test_prefers_best_muxed_format_that_fits():
+    info = {"formats": [fmt("18", 10 * MB, height=360), fmt("22", 40 * MB, height=720),
+                        fmt("37", 90 * MB, height=1080), video("137", 30 * MB, height=1080),
+                        audio("140", 5 * MB)]}
+    assert select_format(info, "video", LIMIT) == "22"
+
+
+def test_pairs_best_fitting_video_with_smallest_audio():
+    info = {"formats": [video("136", 20 * MB, height=720), video("137", 45 * MB, height=1080),
+                        video("299", 80 * MB, height=1440), audio("139", 2 * MB), audio("140", 6 * MB)]}
+    assert select_format(info, "video", LIMIT) == "137+139"
+
+
+def test_pair_over_limit_raises():
+    info = {"formats": [video("137", 49 * MB), audio("140", 2 * MB)]}
+    with pytest.raises(TooLarge):
+        select_format(info, "video", LIMIT)
+
+
+def test_video_only_clip_uses_best_fitting_video():
+    info = {"formats": [video("low", 2 * MB, height=480), video("high", 5 * MB, height=720)]}
+    assert select_format(info, "video", LIMIT) == "high"
+    assert select_format(info, "video", 300 * MB) == "high"
+
+
+def test_video_only_clip_over_limit_raises():
+    info = {"formats": [video("high", 80 * MB, height=720)]}
+    with pytest.raises(TooLarge):
+        select_format(info, "video", LIMIT)
+
+
+def test_audio_mode_picks_best_fitting_audio():
+    info = {"formats": [audio("139", 2 * MB, abr=48), audio("140", 5 * MB, abr=128),
+                        audio("251", 60 * MB, abr=320), fmt("22", 10 * MB)]}
+    assert select_format(info, "audio", LIMIT) == "140"
+
+
+def test_audio_mode_all_too_large_raises():
+    info = {"formats": [audio("251", 60 * MB)]}
+    with pytest.raises(TooLarge):
+        select_format(info, "audio", LIMIT)
+
+
+def test_audio_mode_without_audio_only_formats_defers_to_yt_dlp():
+    info = {"formats": [fmt("22", 10 * MB)]}
+    assert select_format(info, "audio", LIMIT) is None
+
+
+def test_unknown_sizes_defer_to_yt_dlp():
+    info = {"formats": [fmt("22"), video("137"), audio("140")]}
+    assert select_format(info, "video", LIMIT) is None
+    assert select_format(None, "video", LIMIT) is None
+
+
+def test_size_estimated_from_bitrate_and_duration():
+    info = {"duration": 100, "formats": [fmt("hi", tbr=8000, height=720), fmt("lo", tbr=2000, height=360)]}
+    # 8000 kbit/s * 100 s = 100 MB, 2000 kbit/s * 100 s = 25 MB
+    assert select_format(info, "video", LIMIT) == "lo"